@@ -0,0 +1,36 @@
+from threading import Event
+
+
+class OperationCancelled(Exception):
+    """
+    Raised from inside a pipeline once its cancellation token has been cancelled.
+    """
+
+
+class CancellationToken:
+    """
+    A thread-safe flag that long-running work polls to stop early.
+    """
+
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise OperationCancelled("Operation was cancelled.")
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Sleep for up to `timeout` seconds, waking up early on cancellation.
+
+        Returns:
+            bool: True if the token was cancelled.
+        """
+        return self._event.wait(timeout)
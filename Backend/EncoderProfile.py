@@ -0,0 +1,67 @@
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    """
+    The output format and x264 settings of a render, shared by the moviepy and ffmpeg backends.
+
+    Args:
+        name (str): The name the profile is selected by.
+        width (int): The width of the video.
+        height (int): The height of the video.
+        fps (int): The frame rate of the video.
+        preset (str): The x264 preset, faster presets trade file size for encoding speed.
+        crf (int): The x264 constant rate factor, higher values trade quality for size.
+        tune (str): Optional. The x264 tune.
+        maxrate (str): Optional. Caps the video bitrate, e.g. "1M".
+        audio_bitrate (str): The AAC bitrate.
+    """
+    name: str
+    width: int = 1080
+    height: int = 1920
+    fps: int = 30
+    preset: str = "medium"
+    crf: int = 23
+    tune: str | None = None
+    maxrate: str | None = None
+    audio_bitrate: str = "192k"
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return (self.width, self.height)
+
+    def x264_params(self) -> List[str]:
+        """
+        The rate control and tuning options as ffmpeg arguments.
+        """
+        params = ["-crf", str(self.crf)]
+        if self.tune:
+            params += ["-tune", self.tune]
+        if self.maxrate:
+            params += ["-maxrate", self.maxrate, "-bufsize", self.maxrate]
+        return params
+
+    def moviepy_params(self) -> dict:
+        """
+        The keyword arguments of moviepy's write_videofile that encode with this profile.
+        """
+        return {
+            "codec": "libx264",
+            "preset": self.preset,
+            "fps": self.fps,
+            "audio_bitrate": self.audio_bitrate,
+            "ffmpeg_params": self.x264_params(),
+        }
+
+
+ENCODER_PROFILES = {
+    profile.name: profile
+    for profile in [
+        # A quarter of the pixels at a capped bitrate, for iterating on a video before it is final
+        EncoderProfile("draft", width=540, height=960, preset="ultrafast", crf=30, maxrate="1M", audio_bitrate="96k"),
+        EncoderProfile("final"),
+        EncoderProfile("high", preset="slow", crf=18, tune="film", audio_bitrate="256k"),
+    ]
+}
@@ -0,0 +1,142 @@
+import time
+from dataclasses import dataclass
+from threading import Lock
+
+from backend import LOGGER
+
+
+@dataclass
+class Endpoint:
+    """
+    An endpoint of a service and what the pool has seen of it so far.
+    """
+    url: str
+    latency: float | None = None
+    error_rate: float = 0
+    failures: int = 0
+    open_until: float = 0
+    requests: int = 0
+    # Until when the single request that decides whether an open circuit closes again is under
+    # way, after that another one is let through in case its outcome was never recorded
+    trial_until: float = 0
+
+    @property
+    def score(self) -> float:
+        """
+        Lower is better. Endpoints that have not been used yet are tried first.
+        """
+        return (self.latency or 0) * (1 + 4 * self.error_rate)
+
+    def state(self, failure_threshold: int, now: float) -> str:
+        """
+        "closed" while requests are sent to the endpoint, "open" while it is given a rest, and
+        "half_open" once the rest is over, until a single request succeeds or fails.
+        """
+        if self.failures < failure_threshold:
+            return "closed"
+        return "open" if self.open_until > now else "half_open"
+
+    def to_dict(self, failure_threshold: int) -> dict:
+        return {
+            "url": self.url,
+            "latency": self.latency,
+            "errorRate": self.error_rate,
+            "state": self.state(failure_threshold, time.time()),
+            "requests": self.requests,
+        }
+
+
+class EndpointPool:
+    """
+    Routes requests to the healthiest of several endpoints of the same service.
+
+    Every endpoint keeps a moving average of its latency and error rate, and each request
+    goes to the endpoint with the lowest latency weighted by errors. A failed request counts
+    as taking at least `failure_latency` seconds, so an endpoint that fails quickly does not
+    look fast. After `failure_threshold` failures in a row the circuit of an endpoint opens
+    and it receives no requests for `cooldown` seconds. After that a single request decides
+    whether it closes again, and the circuit opens again if that request fails.
+
+    Args:
+        urls (list[str]): The endpoints, in order of preference while nothing is measured.
+        failure_threshold (int): The number of consecutive failures that open a circuit.
+        cooldown (float): The seconds an open circuit stays open.
+        smoothing (float): The weight of the latest request in the moving averages.
+        failure_latency (float): The least latency a failed request is recorded with.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        failure_threshold: int = 3,
+        cooldown: float = 30,
+        smoothing: float = 0.3,
+        failure_latency: float = 5,
+    ):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.failure_latency = failure_latency
+        self._lock = Lock()
+
+    def choose(self) -> Endpoint:
+        """
+        The endpoint to send the next request to. An endpoint whose circuit is half open gets
+        the next request, but only one. If no endpoint can take a request, the one whose
+        circuit closes first is tried anyway, rather than failing without a request.
+        """
+        now = time.time()
+        with self._lock:
+            states = {endpoint.url: endpoint.state(self.failure_threshold, now) for endpoint in self.endpoints}
+            for endpoint in self.endpoints:
+                if states[endpoint.url] == "half_open" and endpoint.trial_until <= now:
+                    endpoint.trial_until = now + self.cooldown
+                    return endpoint
+            closed = [endpoint for endpoint in self.endpoints if states[endpoint.url] == "closed"]
+            if not closed:
+                return min(self.endpoints, key=lambda endpoint: endpoint.open_until)
+            return min(closed, key=lambda endpoint: endpoint.score)
+
+    def record(self, endpoint: Endpoint, latency: float, ok: bool) -> None:
+        """
+        Update the statistics of an endpoint with the outcome of a request.
+        """
+        a = self.smoothing
+        if not ok:
+            latency = max(latency, self.failure_latency)
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.trial_until = 0
+            endpoint.error_rate = (1 - a) * endpoint.error_rate + a * (0 if ok else 1)
+            endpoint.latency = latency if endpoint.latency is None else (1 - a) * endpoint.latency + a * latency
+            if ok:
+                endpoint.failures = 0
+                endpoint.open_until = 0
+                return
+
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.open_until = time.time() + self.cooldown
+                LOGGER.warning(
+                    f"Endpoint '{endpoint.url}' failed {endpoint.failures} times in a row, "
+                    f"not using it for {self.cooldown:.0f}s."
+                )
+
+    def open(self, endpoint: Endpoint) -> None:
+        """
+        Open the circuit of an endpoint that is known to be down.
+        """
+        with self._lock:
+            endpoint.failures = max(endpoint.failures, self.failure_threshold)
+            endpoint.open_until = time.time() + self.cooldown
+
+    @property
+    def available(self) -> bool:
+        now = time.time()
+        with self._lock:
+            return any(endpoint.state(self.failure_threshold, now) != "open" for endpoint in self.endpoints)
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [endpoint.to_dict(self.failure_threshold) for endpoint in self.endpoints]
@@ -0,0 +1,236 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from threading import Lock
+from typing import Callable
+from uuid import uuid4
+
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken, OperationCancelled
+
+
+class JobState(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@dataclass
+class Job:
+    """
+    A single video generation request and its progress.
+    """
+    request_data: dict
+    id: str = field(default_factory=lambda: uuid4().hex)
+    state: JobState = JobState.QUEUED
+    stage: str | None = None
+    stages: dict[str, str] = field(default_factory=dict)
+    timings: dict[str, float] = field(default_factory=dict)
+    # Seconds stages waited for a shared slot before they started working, not part of `timings`
+    waits: dict[str, float] = field(default_factory=dict)
+    artifacts: dict[str, str | list[str]] = field(default_factory=dict)
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    batch_id: str | None = None
+    cancel_token: CancellationToken = field(default_factory=CancellationToken, repr=False)
+
+    def set_stage(self, stage: str, state: str = "running") -> None:
+        self.stages[stage] = state
+        if state == "running":
+            self.stage = stage
+        LOGGER.info(f"Job '{self.id}' stage '{stage}' is {state}.")
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (JobState.SUCCEEDED, JobState.FAILED, JobState.CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state.value,
+            "stage": self.stage,
+            "stages": self.stages,
+            "timings": dict(self.timings),
+            "waits": dict(self.waits),
+            "artifacts": self.artifacts,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            "batchId": self.batch_id,
+        }
+
+
+@dataclass
+class Batch:
+    """
+    A group of jobs submitted together, reported on as a whole.
+    """
+    jobs: list[Job]
+    id: str = field(default_factory=lambda: uuid4().hex)
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return all(job.finished for job in self.jobs)
+
+    def report(self) -> dict:
+        """
+        The state of every item, and the throughput of the batch so far: finished videos per
+        hour since the batch was submitted, the time worked per stage, and the time stages
+        waited for a shared slot, like an encode slot, before they started.
+        """
+        def summary(samples: dict[str, list[float]]) -> dict:
+            return {
+                stage: {"mean": sum(seconds) / len(seconds), "total": sum(seconds), "count": len(seconds)}
+                for stage, seconds in samples.items()
+            }
+
+        counts = {state.value: 0 for state in JobState}
+        stage_seconds: dict[str, list[float]] = {}
+        wait_seconds: dict[str, list[float]] = {}
+        for job in self.jobs:
+            counts[job.state.value] += 1
+            # Snapshots, the worker threads keep updating them
+            for stage, seconds in dict(job.timings).items():
+                stage_seconds.setdefault(stage, []).append(seconds)
+            for stage, seconds in dict(job.waits).items():
+                wait_seconds.setdefault(stage, []).append(seconds)
+
+        finished_at = max(job.finished_at for job in self.jobs) if self.finished else None
+        elapsed = (finished_at or time.time()) - self.created_at
+        succeeded = counts[JobState.SUCCEEDED.value]
+
+        return {
+            "id": self.id,
+            "createdAt": self.created_at,
+            "finishedAt": finished_at,
+            "counts": counts,
+            "items": [
+                {
+                    "index": i,
+                    "jobId": job.id,
+                    "videoSubject": job.request_data.get("videoSubject"),
+                    "state": job.state.value,
+                    "stage": job.stage,
+                    "error": job.error,
+                    "final": job.artifacts.get("final"),
+                }
+                for i, job in enumerate(self.jobs)
+            ],
+            "throughput": {
+                "elapsedSeconds": elapsed,
+                "videosPerHour": succeeded / elapsed * 3600 if elapsed > 0 else 0,
+                "stageSeconds": summary(stage_seconds),
+                "waitSeconds": summary(wait_seconds),
+            },
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded pool of worker threads so that requests return immediately.
+
+    Args:
+        runner (Callable[[Job], None]): Executes a job, raising on failure.
+        max_workers (int): The number of jobs that may run at the same time.
+        max_history (int): The number of finished jobs kept around for status polling.
+        on_finished (Callable[[Job], None]): Optional. Called with every job once it has finished.
+    """
+
+    def __init__(
+        self,
+        runner: Callable[[Job], None],
+        max_workers: int = 2,
+        max_history: int = 1000,
+        on_finished: Callable[[Job], None] | None = None,
+    ):
+        self._runner = runner
+        self._on_finished = on_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._batches: OrderedDict[str, Batch] = OrderedDict()
+        self._lock = Lock()
+        self.max_history = max_history
+
+    def submit(self, request_data: dict, batch_id: str | None = None) -> Job:
+        job = Job(request_data=request_data, batch_id=batch_id)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job)
+        LOGGER.info(f"Job '{job.id}' queued.")
+        return job
+
+    def submit_batch(self, requests: list[dict]) -> Batch:
+        """
+        Queue a job for every request. The jobs share the worker pool with all other jobs and
+        start in the order they were submitted.
+        """
+        batch = Batch(jobs=[])
+        with self._lock:
+            self._batches[batch.id] = batch
+            while len(self._batches) > self.max_history:
+                self._batches.popitem(last=False)
+        for request_data in requests:
+            batch.jobs.append(self.submit(request_data, batch_id=batch.id))
+        LOGGER.info(f"Batch '{batch.id}' of {len(requests)} jobs queued.")
+        return batch
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id: str) -> Batch | None:
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def cancel(self, job_id: str) -> Job | None:
+        """
+        Request cancellation of a job. Queued jobs never start, running jobs stop at their next check.
+        """
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_token.cancel()
+            LOGGER.info(f"Job '{job.id}' cancellation requested.")
+        return job
+
+    def cancel_all(self) -> list[Job]:
+        return [self.cancel(job.id) for job in self.jobs() if not job.finished]
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _trim(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job) -> None:
+        job.state = JobState.RUNNING
+        job.started_at = time.time()
+        try:
+            job.cancel_token.raise_if_cancelled()
+            self._runner(job)
+            job.state = JobState.SUCCEEDED
+        except OperationCancelled:
+            LOGGER.info(f"Job '{job.id}' cancelled in stage '{job.stage}'.")
+            job.state = JobState.CANCELLED
+        except Exception as e:
+            LOGGER.exception(f"Job '{job.id}' failed in stage '{job.stage}'.")
+            job.error = str(e)
+            job.state = JobState.FAILED
+        finally:
+            job.finished_at = time.time()
+            if self._on_finished:
+                self._on_finished(job)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,273 @@
+import atexit
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+
+from backend import LOGGER
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Seconds between two writes of the index
+SAVE_INTERVAL = 30
+
+# Files that are not in the index are downloads that never finished or were added after the index
+# was last written, unless they are younger than this, then another process may still be using them
+ORPHAN_AGE = 3600
+
+
+class MediaStore:
+    """
+    A content-addressed store for downloaded media that is shared between projects.
+
+    Files are kept under `root` by key and tracked in an index that is loaded into memory,
+    so lookups never scan the directory. Changes are made in memory and the index is written at
+    most every `SAVE_INTERVAL` seconds and on exit; files that a crash left out of it are removed
+    the next time the store is loaded. Several processes, like the server and the cli, may share
+    a store: the index is merged with the one on disk under a file lock before it is written, so
+    no process drops the files of another. When the store grows beyond `max_bytes` the least
+    recently used files are evicted. Projects get hardlinks to the stored files, so an evicted
+    file stays available to the projects that already use it.
+
+    Args:
+        root (Path): The directory to keep the files and the index in.
+        max_bytes (int): The disk quota of the store, 0 means unlimited.
+    """
+
+    def __init__(self, root: Path = Path("./cache/media"), max_bytes: int = 0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._index_path = self.root / "index.json"
+        self._index: OrderedDict[str, dict] = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._key_locks: dict[str, Lock] = {}
+        # Incremented on every change of the index, so an older snapshot never overwrites a newer one
+        self._version = 0
+        self._saved_version = 0
+        self._saved_at = time.time()
+        self._save_lock = Lock()
+        self._load()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _file_lock(self):
+        # Serializes reading and writing the index between processes
+        with open(self.root / "index.lock", "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _read_index(self) -> dict[str, dict]:
+        # Must be called holding the file lock
+        if not self._index_path.exists():
+            return {}
+        with open(self._index_path, "r") as f:
+            return json.load(f)
+
+    def _merge(self, entries: dict[str, dict]) -> None:
+        """
+        Take over the entries another process added to the index on disk, and the later of
+        both accesses for entries known to both. Must be called holding the lock.
+        """
+        for key, entry in entries.items():
+            known = self._index.get(key)
+            if known is not None:
+                known["last_access"] = max(known["last_access"], entry["last_access"])
+            elif (self.root / entry["file"]).exists():
+                self._index[key] = entry
+                self._size += entry["size"]
+        # Oldest access first, so the front of the index is what gets evicted first
+        for key, _ in sorted(self._index.items(), key=lambda kv: kv[1]["last_access"]):
+            self._index.move_to_end(key)
+
+    def _load(self) -> None:
+        with self._file_lock():
+            with self._lock:
+                self._merge(self._read_index())
+
+            # Files left behind by a crash would otherwise never count towards the quota
+            indexed = {entry["file"] for entry in self._index.values()}
+            for path in self.root.iterdir():
+                if path.name in indexed or path.name.startswith("index.") or not path.is_file():
+                    continue
+                if time.time() - path.stat().st_mtime > ORPHAN_AGE:
+                    path.unlink(missing_ok=True)
+                    LOGGER.debug(f"Removed '{path.name}' from media store '{self.root}', it is not in the index.")
+
+    def _changed(self) -> None:
+        # Must be called holding the lock
+        self._version += 1
+
+    def _save(self) -> None:
+        """
+        Merge the index with the one on disk and write it. The snapshot is taken holding the
+        lock, but written without it, so lookups are not held up by the disk.
+        """
+        with self._save_lock, self._file_lock():
+            entries = self._read_index()
+            with self._lock:
+                self._merge(entries)
+                # Files another process added count towards the quota as well
+                self._evict(keep=None)
+                version = self._version
+                data = json.dumps(self._index)
+            tmp = self._index_path.with_name(f"{self._index_path.name}.tmp")
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self._index_path)
+            self._saved_version = version
+            self._saved_at = time.time()
+
+    def _save_due(self) -> None:
+        if time.time() - self._saved_at > SAVE_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the index if it changed since it was last written.
+        """
+        if self._version > self._saved_version:
+            self._save()
+
+    def _path(self, key: str, suffix: str = ".mp4") -> Path:
+        return self.root / f"{key}{suffix}"
+
+    def _key_lock(self, key: str) -> Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, Lock())
+
+    def get(self, key: str) -> Path | None:
+        """
+        Look up a stored file and mark it as recently used.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            path = self.root / entry["file"]
+            if not path.exists():
+                self._size -= entry["size"]
+                del self._index[key]
+                self._changed()
+                return None
+            entry["last_access"] = time.time()
+            self._index.move_to_end(key)
+            self._changed()
+        self._save_due()
+        return path
+
+    def put(self, key: str, source: Path) -> Path:
+        """
+        Move a file into the store under the given key, evicting old files if over quota.
+        """
+        source = Path(source)
+        path = self._path(key, source.suffix)
+        if source != path:
+            os.replace(source, path)
+        size = path.stat().st_size
+        with self._lock:
+            if key in self._index:
+                self._size -= self._index[key]["size"]
+            self._index[key] = {"file": path.name, "size": size, "last_access": time.time()}
+            self._index.move_to_end(key)
+            self._size += size
+            self._evict(keep=key)
+            self._changed()
+        self._save_due()
+        return path
+
+    def _evict(self, keep: str | None) -> None:
+        if self.max_bytes <= 0:
+            return
+        while self._size > self.max_bytes and len(self._index) > 1:
+            key, entry = next(iter(self._index.items()))
+            if key == keep:
+                break
+            del self._index[key]
+            self._size -= entry["size"]
+            (self.root / entry["file"]).unlink(missing_ok=True)
+            LOGGER.debug(f"Evicted '{key}' from media store '{self.root}'.")
+
+    @staticmethod
+    def link(source: Path, target: Path) -> Path:
+        """
+        Hardlink a stored file to the target, falling back to a copy across filesystems.
+        """
+        target.unlink(missing_ok=True)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+        return target
+
+    def _ensure(self, key: str, download: Callable[[Path], Path | None], suffix: str) -> Path | None:
+        # Must be called holding the lock of the key
+        stored = self.get(key)
+        if stored is None:
+            downloaded = download(self._path(key, suffix))
+            if downloaded is None:
+                return None
+            stored = self.put(key, downloaded)
+        else:
+            LOGGER.debug(f"Media store hit for '{key}'.")
+        return stored
+
+    def ensure(self, key: str, download: Callable[[Path], Path | None], suffix: str = ".mp4") -> Path | None:
+        """
+        Download the file for a key into the store if it is not stored yet, without linking
+        it anywhere. Concurrent calls for the same key download it once.
+
+        Returns:
+            Path: The stored file, or None if the download failed.
+        """
+        with self._key_lock(key):
+            return self._ensure(key, download, suffix)
+
+    def fetch(self, key: str, target: Path, download: Callable[[Path], Path | None], suffix: str = ".mp4") -> Path | None:
+        """
+        Provide the file for a key at the target path, downloading it into the store only if
+        it is not stored yet. Concurrent fetches of the same key download it once.
+
+        Args:
+            key (str): The key of the file.
+            target (Path): Where the file should appear, usually inside a project.
+            download (Callable[[Path], Path | None]): Downloads the file to the given path,
+                returning None on failure.
+            suffix (str): The file extension of the stored file.
+
+        Returns:
+            Path: The target path, or None if the download failed.
+        """
+        with self._key_lock(key):
+            stored = self._ensure(key, download, suffix)
+            return None if stored is None else self.link(stored, target)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __str__(self):
+        return str(self.root)
+
+    def __repr__(self):
+        return self.__str__()
@@ -1,40 +1,150 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
 import hashlib
+import os
+import tempfile
+import time
 from pathlib import Path
+from threading import Lock
 
 
 class Cache(ABC):
     def hash_key(self, key):
-        return hashlib.sha256(key.encode()).hexdigest()
+        if isinstance(key, str):
+            key = key.encode()
+        return hashlib.sha256(key).hexdigest()
 
     @abstractmethod
-    def get(self, key):
+    def get(self, key, namespace="default"):
         pass
 
     @abstractmethod
-    def set(self, key, value):
+    def set(self, key, value, namespace="default"):
         pass
 
 
 class RequestCache(Cache):
-    def __init__(self):
-        self.cache = Path("./cache")
+    """
+    A two-tier cache for responses of external APIs.
+
+    A bounded in-memory LRU sits in front of an on-disk store that is sharded by the first
+    two characters of the hashed key (`<root>/<namespace>/<ab>/<hash>`). Values may be text
+    or bytes and expire after the TTL of their namespace. Disk writes go through a temporary
+    file and a rename, so concurrent readers never see a partial value.
+
+    Args:
+        root (Path): The directory of the on-disk tier.
+        ttls (dict[str, float]): Optional. Time to live in seconds per namespace, namespaces
+            that are not listed never expire.
+        max_memory_items (int): The maximum number of values kept in memory.
+        max_memory_bytes (int): The maximum total size of the values kept in memory.
+    """
+
+    _TEXT = b"T"
+    _BINARY = b"B"
+
+    def __init__(
+        self,
+        root: Path = Path("./cache"),
+        ttls: dict[str, float] | None = None,
+        max_memory_items: int = 512,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.cache = Path(root)
         self.cache.mkdir(parents=True, exist_ok=True)
+        self.ttls = ttls or {}
+        self.max_memory_items = max_memory_items
+        self.max_memory_bytes = max_memory_bytes
+        self._memory: OrderedDict[tuple[str, str], tuple[str | bytes, float]] = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = Lock()
+        self._stats = defaultdict(lambda: {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0})
+
+    def _path(self, namespace: str, h: str) -> Path:
+        return self.cache / namespace / h[:2] / h
 
-    def get(self, key):
+    def _expired(self, namespace: str, stored_at: float) -> bool:
+        ttl = self.ttls.get(namespace)
+        return ttl is not None and time.time() - stored_at > ttl
+
+    def _remember(self, namespace: str, h: str, value: str | bytes, stored_at: float) -> None:
+        size = len(value)
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop((namespace, h), None)
+            if old is not None:
+                self._memory_bytes -= len(old[0])
+            self._memory[(namespace, h)] = (value, stored_at)
+            self._memory_bytes += size
+            while len(self._memory) > self.max_memory_items or self._memory_bytes > self.max_memory_bytes:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _count(self, namespace: str, counter: str) -> None:
+        with self._lock:
+            self._stats[namespace][counter] += 1
+
+    def get(self, key, namespace="default"):
         h = self.hash_key(key)
-        if (self.cache / h).exists():
-            with open(self.cache / h, "r") as f:
-                return f.read()
-        return None
 
-    def set(self, key, value):
+        with self._lock:
+            cached = self._memory.get((namespace, h))
+            if cached is not None and not self._expired(namespace, cached[1]):
+                self._memory.move_to_end((namespace, h))
+                self._stats[namespace]["memory_hits"] += 1
+                return cached[0]
+
+        path = self._path(namespace, h)
+        try:
+            stored_at = path.stat().st_mtime
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._count(namespace, "misses")
+            return None
+
+        if self._expired(namespace, stored_at):
+            path.unlink(missing_ok=True)
+            self._count(namespace, "misses")
+            return None
+
+        value = data[1:].decode() if data[:1] == self._TEXT else data[1:]
+        self._remember(namespace, h, value, stored_at)
+        self._count(namespace, "disk_hits")
+        return value
+
+    def set(self, key, value, namespace="default"):
         h = self.hash_key(key)
-        with open(self.cache / h, "w") as f:
-            f.write(value)
+        path = self._path(namespace, h)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        data = self._TEXT + value.encode() if isinstance(value, str) else self._BINARY + bytes(value)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{h}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+        self._remember(namespace, h, value, time.time())
+        self._count(namespace, "writes")
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        Hit and miss counters per namespace since the cache was created.
+        """
+        with self._lock:
+            return {namespace: dict(counters) for namespace, counters in self._stats.items()}
 
     def __str__(self):
         return str(self.cache)
 
     def __repr__(self):
         return self.__str__()
+
+
+# Pexels results change over time, LLM completions for the same input do not need to
+REQUEST_CACHE = RequestCache(ttls={"pexels": 24 * 60 * 60})
@@ -0,0 +1,107 @@
+import re
+from datetime import timedelta
+from typing import List
+
+import numpy as np
+import srt
+
+from backend.audio import WINDOW, AudioManifest
+
+# The most characters of a caption, words longer than that get a caption of their own
+MAX_CAPTION_CHARS = 10
+
+# Windows quieter than this fraction of the loudest window of a part are not speech
+VOICED_THRESHOLD = 0.05
+
+VOWEL_GROUPS = re.compile(r"[aeiouyàáâãäåæèéêëìíîïòóôõöøœùúûüýÿāēīōū]+")
+
+
+def syllables(word: str) -> int:
+    """
+    A rough count of the syllables of a word: its groups of vowels, every digit counted as
+    one, and at least one. Only used to weigh the words of a sentence against each other.
+    """
+    word = word.lower()
+    return max(1, len(VOWEL_GROUPS.findall(word)) + sum(c.isdigit() for c in word))
+
+
+def chunk_words(words: List[str], max_chars: int = MAX_CAPTION_CHARS) -> List[List[str]]:
+    """
+    Group the words into captions of at most `max_chars` characters, filling every caption
+    before starting the next one like srt_equalizer does.
+    """
+    chunks = []
+    current = []
+    for word in words:
+        if current and len(" ".join(current + [word])) > max_chars:
+            chunks.append(current)
+            current = []
+        current.append(word)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def time_chunks(chunks: List[List[str]], rms: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Split a sentence between its captions by the loudness of the sentence.
+
+    Every caption gets a share of the time the sentence is voiced that is proportional to
+    its syllables. Pauses are skipped while measuring out the shares, so a boundary never
+    falls inside a pause, and a pause stays with the caption before it. Silence before the
+    first and after the last word is left out. Without voiced windows the whole sentence
+    is shared by syllables.
+
+    Returns:
+        np.ndarray: Where every caption starts and the last one ends, as fractions of the sentence.
+    """
+    weights = np.cumsum([sum(syllables(word) for word in chunk) for chunk in chunks], dtype=float)
+    voiced = rms >= threshold
+    onsets = np.flatnonzero(voiced)
+    if len(onsets) == 0:
+        return np.concatenate([[0], weights / weights[-1]])
+
+    first, last = onsets[0], onsets[-1] + 1
+    spoken = np.cumsum(voiced[first:last])
+    # The next caption starts at the first voiced window after its predecessor's share
+    shares = np.round(weights[:-1] / weights[-1] * spoken[-1])
+    boundaries = first + np.searchsorted(spoken, shares, side="right")
+    return np.concatenate([[first], boundaries, [last]]) / len(rms)
+
+
+def align(manifest: AudioManifest, max_chars: int = MAX_CAPTION_CHARS) -> List[srt.Subtitle]:
+    """
+    Caption the narration without transcribing it, from the sentences it was synthesized from
+    and the loudness of its parts.
+
+    The sentences are timed by the manifest. Within a sentence, captions follow the speech
+    as measured by `time_chunks`, so they switch as the words are spoken instead of at an
+    even pace. Consecutive captions touch, so none flicker off between them.
+
+    Returns:
+        List[srt.Subtitle]: The captions, at most `max_chars` long unless a word is longer.
+    """
+    captions = []
+    offset = 0.0
+    for part in manifest.parts:
+        rms = part.loudness()
+        threshold = VOICED_THRESHOLD * rms.max() if len(rms) else 0
+        start = 0.0
+        for sentence, duration in zip(part.sentences, part.sentence_durations):
+            end = start + duration
+            chunks = chunk_words(sentence.split(), max_chars)
+            if chunks:
+                window = rms[int(round(start / WINDOW)):int(round(end / WINDOW))]
+                times = start + time_chunks(chunks, window, threshold) * duration
+                # The first caption shows from the start of the sentence, the last until its end
+                times[0], times[-1] = start, end
+                for chunk, chunk_start, chunk_end in zip(chunks, times, times[1:]):
+                    captions.append(srt.Subtitle(
+                        index=len(captions) + 1,
+                        start=timedelta(seconds=offset + chunk_start),
+                        end=timedelta(seconds=offset + chunk_end),
+                        content=" ".join(chunk),
+                    ))
+            start = end
+        offset += part.duration
+    return captions
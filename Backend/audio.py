@@ -0,0 +1,328 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterator, List
+
+import numpy as np
+from moviepy.audio.io.AudioFileClip import AudioFileClip
+
+# Bitrates in kbit/s by (MPEG version 1 or not, layer) and bitrate index
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates by version bits and sample rate index
+SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],  # MPEG 1
+    0b10: [22050, 24000, 16000],  # MPEG 2
+    0b00: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+
+@dataclass
+class Frame:
+    """
+    An MPEG audio frame: where it starts in the file, how long it is and what it holds.
+    """
+    offset: int
+    length: int
+    samples: int
+    sample_rate: int
+    channels: int
+    is_info: bool
+
+
+def skip_id3(data: bytes) -> int:
+    """
+    The offset of the first frame, after an ID3v2 tag if there is one.
+    """
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def parse_frame(data: bytes, offset: int) -> Frame | None:
+    """
+    Parse the frame header at the offset, None if there is no valid header.
+    """
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[offset + 1] >> 3) & 0b11
+    layer = 4 - ((data[offset + 1] >> 1) & 0b11)
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0b11
+    padding = (data[offset + 2] >> 1) & 1
+    channels = 1 if data[offset + 3] >> 6 == 0b11 else 2
+    if version == 0b01 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 0b11
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or mpeg1:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+
+    # Encoders write a Xing or Info tag into a first frame that holds no audio
+    side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+    tag = data[offset + 4 + side_info:offset + 8 + side_info]
+    return Frame(offset, length, samples, sample_rate, channels, is_info=tag in (b"Xing", b"Info"))
+
+
+def frames(data: bytes) -> Iterator[Frame]:
+    """
+    The audio frames of an MP3, read from their headers without decoding them. Bytes that are
+    not a frame, like a trailing ID3v1 tag, are skipped.
+    """
+    offset = skip_id3(data)
+    first = True
+    while offset + 4 <= len(data):
+        frame = parse_frame(data, offset)
+        if frame is None:
+            offset += 1
+            continue
+        if not (first and frame.is_info):
+            yield frame
+        first = False
+        offset += frame.length
+
+
+def mp3_duration(path: Path) -> float:
+    """
+    The duration of an MP3 in seconds, counted from its frame headers.
+    """
+    return sum(frame.samples / frame.sample_rate for frame in frames(Path(path).read_bytes()))
+
+
+def concat_mp3(parts: List[Path], target: Path) -> Path:
+    """
+    Concatenate MP3s by copying their audio frames, without decoding or encoding them. Tags
+    and the Info frames of the parts are left out, since they describe the parts only.
+
+    Raises:
+        ValueError: If the parts do not share a sample rate and channel count, they then
+            have to be decoded to be concatenated.
+    """
+    formats = set()
+    partial = target.with_name(f"{target.stem}.part{target.suffix}")
+    try:
+        with open(partial, "wb") as f:
+            for part in parts:
+                data = Path(part).read_bytes()
+                for frame in frames(data):
+                    formats.add((frame.sample_rate, frame.channels))
+                    if len(formats) > 1:
+                        raise ValueError(f"Cannot copy '{part}', the parts differ in sample rate or channels.")
+                    f.write(data[frame.offset:frame.offset + frame.length])
+        os.replace(partial, target)
+    finally:
+        partial.unlink(missing_ok=True)
+    return target
+
+
+# The sample rate speech is analysed at, and the length of the windows its loudness is measured over
+ANALYSIS_FPS = 16000
+WINDOW = 0.01
+
+
+def decode(path: Path, fps: int) -> np.ndarray:
+    """
+    Decode an audio file into mono samples at the given sample rate.
+    """
+    clip = AudioFileClip(str(path), fps=fps)
+    try:
+        samples = clip.to_soundarray(fps=fps)
+    finally:
+        clip.close()
+    return samples.mean(axis=1) if samples.ndim > 1 else samples
+
+
+def loudness(samples: np.ndarray, fps: int, window: float = WINDOW) -> np.ndarray:
+    """
+    The RMS loudness of every `window` seconds of the samples. A trailing window that is
+    not full is left out.
+    """
+    size = max(1, int(window * fps))
+    n = len(samples) // size
+    return np.sqrt(np.mean(samples[:n * size].reshape(n, size) ** 2, axis=1))
+
+
+def find_silences(
+    rms: np.ndarray,
+    window: float = WINDOW,
+    threshold: float = 0.05,
+    min_duration: float = 0.08,
+) -> List[tuple[float, float]]:
+    """
+    Find the pauses in speech: runs of windows whose loudness stays below `threshold` times
+    the loudest window for at least `min_duration` seconds. Silence at the very start and end
+    is not a pause and is left out.
+
+    Args:
+        rms (np.ndarray): The loudness of the speech, see `loudness`.
+        window (float): The seconds every value of `rms` covers.
+
+    Returns:
+        List[tuple[float, float]]: The (start, end) times of the pauses in seconds.
+    """
+    n = len(rms)
+    if n == 0:
+        return []
+    quiet = rms < threshold * rms.max()
+
+    silences = []
+    start = None
+    for i, is_quiet in enumerate(np.append(quiet, False)):
+        if is_quiet and start is None:
+            start = i
+        elif not is_quiet and start is not None:
+            if start > 0 and i < n and (i - start) * window >= min_duration:
+                silences.append((start * window, i * window))
+            start = None
+    return silences
+
+
+def split_durations(rms: np.ndarray, texts: List[str], duration: float, window: float = WINDOW) -> List[float]:
+    """
+    Split the duration of a clip that speaks several sentences into the duration of each.
+
+    Every boundary is placed in the middle of the pause closest to where it is expected from
+    the length of the texts, preferring longer pauses, since the pause after a sentence is
+    usually longer than one after a comma. Boundaries without a pause after the previous
+    one are placed where they are expected.
+
+    Args:
+        rms (np.ndarray): The loudness of the clip, see `loudness`.
+
+    Returns:
+        List[float]: The duration of every sentence, together exactly the duration of the clip.
+    """
+    if len(texts) == 1:
+        return [duration]
+
+    # The middle and the length of every pause
+    pauses = [((start + end) / 2, end - start) for start, end in find_silences(rms, window)]
+    total_chars = sum(len(text) for text in texts)
+    boundaries = []
+    chars = 0
+    previous = 0.0
+    for text in texts[:-1]:
+        chars += len(text)
+        expected = duration * chars / total_chars
+        candidates = [(middle, length) for middle, length in pauses if middle > previous]
+        if candidates:
+            boundary = min(candidates, key=lambda pause: abs(pause[0] - expected) - pause[1])[0]
+        else:
+            boundary = max(expected, previous)
+        boundaries.append(boundary)
+        previous = boundary
+
+    edges = [0.0] + boundaries + [duration]
+    return [end - start for start, end in zip(edges, edges[1:])]
+
+
+@dataclass
+class AudioPart:
+    """
+    A clip of the narration, which speaks one or more consecutive sentences.
+    """
+    path: str
+    text: str
+    duration: float
+    sentences: List[str] = field(default_factory=list)
+    sentence_durations: List[float] = field(default_factory=list)
+
+    def __post_init__(self):
+        # Manifests written before parts were packed hold a single sentence per part
+        if not self.sentences:
+            self.sentences = [self.text]
+            self.sentence_durations = [self.duration]
+
+    @property
+    def loudness_path(self) -> Path:
+        return Path(self.path).with_suffix(".rms.npy")
+
+    def measure(self) -> np.ndarray:
+        """
+        Decode the part and store its loudness every `WINDOW` seconds next to it.
+        """
+        rms = loudness(decode(Path(self.path), ANALYSIS_FPS), ANALYSIS_FPS).astype(np.float32)
+        np.save(self.loudness_path, rms)
+        return rms
+
+    def loudness(self) -> np.ndarray:
+        """
+        The loudness of the part as stored by `measure`. Parts of older manifests are measured
+        the first time.
+        """
+        if self.loudness_path.exists():
+            return np.load(self.loudness_path)
+        return self.measure()
+
+
+@dataclass
+class AudioManifest:
+    """
+    The parts the narration is made of, in order, with their durations and the durations
+    of the sentences in them.
+
+    Durations are read from the MP3 headers once when the parts are synthesized, so nothing
+    that needs the timing of the narration has to open the audio again. Every part is decoded
+    once to measure its loudness, which places the pauses between the sentences of a part and
+    the captions of the local subtitles.
+    """
+    parts: List[AudioPart]
+
+    @property
+    def duration(self) -> float:
+        return sum(part.duration for part in self.parts)
+
+    @property
+    def sentences(self) -> List[str]:
+        return [sentence for part in self.parts for sentence in part.sentences]
+
+    @property
+    def sentence_durations(self) -> List[float]:
+        return [duration for part in self.parts for duration in part.sentence_durations]
+
+    @classmethod
+    def from_parts(cls, paths: List[Path], packs: List[List[str]], texts: List[str] | None = None) -> "AudioManifest":
+        """
+        Args:
+            paths (List[Path]): The parts.
+            packs (List[List[str]]): The sentences every part speaks.
+            texts (List[str]): Optional. The texts the parts were synthesized from, by
+                default their sentences joined by spaces.
+        """
+        texts = texts or [" ".join(pack) for pack in packs]
+        parts = []
+        for path, pack, text in zip(paths, packs, texts):
+            part = AudioPart(path=str(path), text=text, duration=mp3_duration(path), sentences=list(pack))
+            part.sentence_durations = split_durations(part.measure(), part.sentences, part.duration)
+            parts.append(part)
+        return cls(parts)
+
+    def save(self, path: Path) -> None:
+        partial = path.with_name(f"{path.name}.part")
+        with open(partial, "w") as f:
+            json.dump({"parts": [asdict(part) for part in self.parts]}, f, indent=4)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "AudioManifest":
+        with open(path, "r") as f:
+            return cls([AudioPart(**part) for part in json.load(f)["parts"]])
@@ -0,0 +1,225 @@
+import subprocess
+from pathlib import Path
+from typing import List
+
+from moviepy.config import get_setting
+from PIL import ImageColor, ImageFont
+from termcolor import colored
+
+from backend.CancellationToken import CancellationToken
+from backend.EncoderProfile import ENCODER_PROFILES, EncoderProfile
+from backend.subtitles import FONT_PATH, FONT_SIZE, REFERENCE_HEIGHT, STROKE_WIDTH
+from backend.video import TimelineEntry
+
+# libass renders SRT subtitles on a canvas this many pixels high and scales it to the video
+ASS_PLAY_RES_Y = 288
+
+# ASS alignments follow the numpad layout
+ALIGNMENTS = {
+    ("left", "bottom"): 1, ("center", "bottom"): 2, ("right", "bottom"): 3,
+    ("left", "center"): 4, ("center", "center"): 5, ("right", "center"): 6,
+    ("left", "top"): 7, ("center", "top"): 8, ("right", "top"): 9,
+}
+
+
+def ass_color(color: str) -> str:
+    """
+    Converts a color name or hex code into the &HAABBGGRR notation of ASS.
+    """
+    r, g, b = ImageColor.getrgb(color)[:3]
+    return f"&H00{b:02X}{g:02X}{r:02X}"
+
+
+def escape_path(path: Path) -> str:
+    """
+    Escapes a path for use as a quoted option value inside a filtergraph.
+    """
+    return str(Path(path).resolve().as_posix()).replace(":", r"\:").replace("'", r"\'")
+
+
+def subtitles_style(subtitles_position: str, text_color: str) -> str:
+    """
+    Builds the libass style that matches the subtitles of the moviepy backend. libass scales
+    the style with the height of the video, like the moviepy backend does.
+    """
+    horizontal, vertical = subtitles_position.split(",")
+    scale = ASS_PLAY_RES_Y / REFERENCE_HEIGHT
+    font_name = ImageFont.truetype(str(FONT_PATH)).getname()[0]
+    return ",".join([
+        f"FontName={font_name}",
+        f"FontSize={round(FONT_SIZE * scale)}",
+        f"PrimaryColour={ass_color(text_color)}",
+        "OutlineColour=&H00000000",
+        "BorderStyle=1",
+        f"Outline={STROKE_WIDTH * scale:.2f}",
+        "Shadow=0",
+        f"Alignment={ALIGNMENTS.get((horizontal.strip(), vertical.strip()), 2)}",
+    ])
+
+
+def build_render_command(
+    timeline: List[TimelineEntry],
+    tts_path: Path,
+    duration: float,
+    subtitles_path: Path,
+    subtitles_position: str,
+    text_color: str,
+    threads: int,
+    target: Path,
+    music_path: Path | None = None,
+    profile: EncoderProfile = ENCODER_PROFILES["final"],
+    prenormalized: bool = False,
+) -> List[str]:
+    """
+    Builds a single ffmpeg invocation that crops, scales and concatenates the clips, burns in
+    the subtitles, adds the narration and the optional music, and encodes the result once.
+
+    Args:
+        timeline (List[TimelineEntry]): The clips in the order they are shown.
+        tts_path (Path): The narration.
+        duration (float): The duration of the narration, which is the duration of the video.
+        subtitles_path (Path): The SRT subtitles.
+        subtitles_position (str): The position of the subtitles, e.g. "center,bottom".
+        text_color (str): The color of the subtitles.
+        threads (int): The number of threads the encoder may use.
+        target (Path): The file to encode to.
+        music_path (Path): Optional. Background music, mixed in at 10% volume.
+        profile (EncoderProfile): The size, frame rate and encoder settings of the video.
+        prenormalized (bool): Whether the clips have been normalized to the size and frame
+            rate of the profile already. They are then concatenated by the demuxer, whose input list is written
+            next to the target, instead of being cropped and scaled one by one.
+
+    Returns:
+        List[str]: The ffmpeg command line.
+    """
+    width, height, fps = profile.width, profile.height, profile.fps
+    args = [get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error"]
+    filters = []
+
+    if prenormalized:
+        # The clips already share size, frame rate and codec, so the concat demuxer can
+        # read them back to back as a single input
+        concat_list = target.with_suffix(".concat.txt")
+        with open(concat_list, "w") as f:
+            for entry in timeline:
+                path = Path(entry.path).resolve().as_posix().replace("'", "'\\''")
+                f.write(f"file '{path}'\noutpoint {entry.duration:.3f}\n")
+        args += ["-f", "concat", "-safe", "0", "-i", str(concat_list)]
+        audio_input = 1
+        filters.append(f"[0:v]fps={fps},setpts=PTS-STARTPTS[vcat]")
+    else:
+        # Every clip is its own input, limited to the part that is shown, so nothing is buffered
+        for entry in timeline:
+            args += ["-t", f"{entry.duration:.3f}", "-i", str(entry.path)]
+        audio_input = len(timeline)
+
+        for i in range(len(timeline)):
+            # Center crop to the aspect ratio of the target, then scale to its size
+            filters.append(
+                f"[{i}:v]crop='min(iw,ih*{width}/{height})':'min(ih,iw*{height}/{width})',"
+                f"scale={width}:{height},fps={fps},setsar=1,setpts=PTS-STARTPTS[v{i}]"
+            )
+        inputs = "".join(f"[v{i}]" for i in range(len(timeline)))
+        filters.append(f"{inputs}concat=n={len(timeline)}:v=1:a=0[vcat]")
+
+    args += ["-i", str(tts_path)]
+    if music_path:
+        args += ["-stream_loop", "-1", "-i", str(music_path)]
+
+    filters.append(
+        f"[vcat]subtitles=filename='{escape_path(subtitles_path)}'"
+        f":fontsdir='{escape_path(FONT_PATH.parent)}'"
+        f":force_style='{subtitles_style(subtitles_position, text_color)}'[vout]"
+    )
+
+    if music_path:
+        filters.append(f"[{audio_input + 1}:a]volume=0.1[music]")
+        filters.append(f"[{audio_input}:a][music]amix=inputs=2:duration=first:normalize=0[aout]")
+        audio_map = "[aout]"
+    else:
+        audio_map = f"{audio_input}:a"
+
+    args += [
+        "-filter_complex", ";".join(filters),
+        "-map", "[vout]",
+        "-map", audio_map,
+        "-c:v", "libx264",
+        "-preset", profile.preset,
+        *profile.x264_params(),
+        "-pix_fmt", "yuv420p",
+        "-r", str(fps),
+        "-c:a", "aac",
+        "-b:a", profile.audio_bitrate,
+        "-threads", str(threads),
+        "-t", f"{duration:.3f}",
+        "-movflags", "+faststart",
+        str(target),
+    ]
+    return args
+
+
+def run_ffmpeg(args: List[str], log_path: Path, cancel_token: CancellationToken | None = None) -> None:
+    """
+    Runs ffmpeg, killing it as soon as the token is cancelled.
+
+    Args:
+        args (List[str]): The ffmpeg command line.
+        log_path (Path): Where ffmpeg's error output is written to, removed after a successful run.
+        cancel_token (CancellationToken): Optional. Kills ffmpeg when cancelled.
+    """
+    cancel_token = cancel_token or CancellationToken()
+    with open(log_path, "wb") as log:
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log)
+        try:
+            while proc.poll() is None:
+                if cancel_token.wait(0.25):
+                    cancel_token.raise_if_cancelled()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    if proc.returncode != 0:
+        error = log_path.read_text(errors="replace").strip().splitlines()[-5:]
+        raise Exception(f"ffmpeg exited with code {proc.returncode}: {' '.join(error)}")
+    log_path.unlink(missing_ok=True)
+
+
+def render_video(
+    timeline: List[TimelineEntry],
+    tts_path: Path,
+    duration: float,
+    subtitles_path: Path,
+    threads: int,
+    subtitles_position: str,
+    text_color: str,
+    target: Path,
+    music_path: Path | None = None,
+    cancel_token: CancellationToken | None = None,
+    prenormalized: bool = False,
+    profile: EncoderProfile = ENCODER_PROFILES["final"],
+) -> Path:
+    """
+    Renders the final video in a single ffmpeg pass, see build_render_command.
+
+    Returns:
+        Path: The path to the final video.
+    """
+    if target.exists():
+        return target
+
+    print(colored(f"[+] Rendering {len(timeline)} clips with ffmpeg...", "blue"))
+
+    partial = target.with_name(f"{target.stem}.part{target.suffix}")
+    args = build_render_command(
+        timeline, tts_path, duration, subtitles_path, subtitles_position, text_color, threads, partial, music_path,
+        profile=profile,
+        prenormalized=prenormalized,
+    )
+    try:
+        run_ffmpeg(args, target.with_suffix(".log"), cancel_token)
+        partial.replace(target)
+    finally:
+        partial.unlink(missing_ok=True)
+        partial.with_suffix(".concat.txt").unlink(missing_ok=True)
+    return target
@@ -4,26 +4,37 @@ import json
 import openai
 from pathlib import Path
 from termcolor import colored
-from typing import Tuple, List, TYPE_CHECKING
+from typing import Iterator, Tuple, List, TYPE_CHECKING
 from decouple import config
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+from backend.RequestCache import REQUEST_CACHE
 
 
 
 # Set environment variables
-OPENAI_API_KEY = config("OPENAI_API_KEY")
+OPENAI_API_KEY = config("OPENAI_API_KEY", default="")
 openai.api_key = OPENAI_API_KEY
-GOOGLE_API_KEY = config("GOOGLE_API_KEY")
+GOOGLE_API_KEY = config("GOOGLE_API_KEY", default="")
 
 if TYPE_CHECKING:
     from backend.project.ProjectConfig import ProjectConfig
 
-def generate_response(prompt: str, model_name: str) -> str | None:
+def response_cache_key(prompt: str, model_name: str, json_mode: bool = False) -> str:
+    request = {"model": model_name, "prompt": prompt}
+    if json_mode:
+        request["format"] = "json"
+    return json.dumps(request)
+
+
+def generate_response(prompt: str, model_name: str, json_mode: bool = False) -> str | None:
     """
     Generate a script for a video, depending on the subject of the video.
 
     Args:
         video_subject (str): The subject of the video.
         model_name (str): The AI model to use for generation.
+        json_mode (bool): Optional. Makes the model answer with a single JSON object.
 
 
     Returns:
@@ -32,42 +43,32 @@ def generate_response(prompt: str, model_name: str) -> str | None:
 
     """
 
+    # Identical prompts are answered from the cache instead of the API
+    cache_key = response_cache_key(prompt, model_name, json_mode)
+    cached = REQUEST_CACHE.get(cache_key, namespace="llm")
+    if cached is not None:
+        return cached
+
     response = (
         openai.chat.completions.create(
             model=model_name,
             messages=[{"role": "user", "content": prompt}],
+            **({"response_format": {"type": "json_object"}} if json_mode else {}),
         )
         .choices[0]
         .message.content
     )
 
+    if response:
+        REQUEST_CACHE.set(cache_key, response, namespace="llm")
+
     return response
 
 
-def generate_script(video_subject: str, paragraph_number: int=1, voice: str="en_us_001", model: str="gpt-3.5-turbo-1106", custom_prompt: str="") -> str:
+def script_prompt(video_subject: str, paragraph_number: int, voice: str, custom_prompt: str = "") -> str:
     """
-    Generate a script for a video, depending on the subject of the video, the number of paragraphs, and the AI model.
-
-
-
-    Args:
-        custom_prompt (str): Optional. A custom prompt to use for the script generation.
-        video_subject (str): The subject of the video.
-
-        paragraph_number (int): The number of paragraphs to generate.
-
-        voice (str): The voice to use for the script generation.
-
-        model (str): The AI model to use for generation.
-
-
-
-    Returns:
-
-        str: The script for the video.
-
+    The prompt that asks for the script of a video, the custom prompt if one is given.
     """
-  
     prompt = custom_prompt if len(custom_prompt) > 0 else f"""
             Generate a script for a video, depending on the subject of the video.
 
@@ -96,6 +97,35 @@ def generate_script(video_subject: str, paragraph_number: int=1, voice: str="en_
 
     """
 
+    return prompt
+
+
+def generate_script(video_subject: str, paragraph_number: int=1, voice: str="en_us_001", model: str="gpt-3.5-turbo-1106", custom_prompt: str="") -> str:
+    """
+    Generate a script for a video, depending on the subject of the video, the number of paragraphs, and the AI model.
+
+
+
+    Args:
+        custom_prompt (str): Optional. A custom prompt to use for the script generation.
+        video_subject (str): The subject of the video.
+
+        paragraph_number (int): The number of paragraphs to generate.
+
+        voice (str): The voice to use for the script generation.
+
+        model (str): The AI model to use for generation.
+
+
+
+    Returns:
+
+        str: The script for the video.
+
+    """
+  
+    prompt = script_prompt(video_subject, paragraph_number, voice, custom_prompt)
+
     # Generate script
     response = generate_response(prompt, model)
 
@@ -103,33 +133,125 @@ def generate_script(video_subject: str, paragraph_number: int=1, voice: str="en_
 
     # Return the generated script
     if response:
-        # Clean the script
-        # Remove asterisks, hashes
-        response = response.replace("*", "")
-        response = response.replace("#", "")
+        return clean_script(response, paragraph_number)
+    else:
+        print(colored("[-] GPT returned an empty response.", "red"))
+        return ""
 
-        # Remove markdown syntax
-        response = re.sub(r"\[.*\]", "", response)
-        response = re.sub(r"\(.*\)", "", response)
 
-        # Split the script into paragraphs
-        paragraphs = response.split("\n\n")
+def clean_script(response: str, paragraph_number: int) -> str:
+    """
+    Strip the markdown from a generated script and keep only the requested number of paragraphs.
+    """
+    # Clean the script
+    # Remove asterisks, hashes
+    response = response.replace("*", "")
+    response = response.replace("#", "")
 
-        # Select the specified number of paragraphs
-        selected_paragraphs = paragraphs[: paragraph_number]
+    # Remove markdown syntax
+    response = re.sub(r"\[.*\]", "", response)
+    response = re.sub(r"\(.*\)", "", response)
 
-        # Join the selected paragraphs into a single string
-        final_script = "\n\n".join(selected_paragraphs)
+    # Split the script into paragraphs
+    paragraphs = response.split("\n\n")
 
-        # Print to console the number of paragraphs used
-        print(
-            colored(f"Number of paragraphs used: {len(selected_paragraphs)}", "green")
-        )
+    # Select the specified number of paragraphs
+    selected_paragraphs = paragraphs[: paragraph_number]
+
+    # Join the selected paragraphs into a single string
+    final_script = "\n\n".join(selected_paragraphs)
+
+    # Print to console the number of paragraphs used
+    print(
+        colored(f"Number of paragraphs used: {len(selected_paragraphs)}", "green")
+    )
+
+    return final_script
+
+
+def stream_script(
+    video_subject: str,
+    paragraph_number: int = 1,
+    voice: str = "en_us_001",
+    model: str = "gpt-3.5-turbo-1106",
+    custom_prompt: str = "",
+) -> Iterator[str]:
+    """
+    Generate a script like `generate_script`, but yield its sentences while it is being
+    generated, each as soon as it is complete.
+
+    The script is cleaned as it arrives, with the same result as `clean_script`: markdown
+    characters are dropped from every token, and the response stops being read once the
+    requested number of paragraphs is complete. Brackets are removed per line from their
+    first opening to their last closing bracket, so from the first bracket on, a line is
+    held back until it is complete.
+
+    Yields:
+        str: The sentences of the cleaned script, split on ". " like the script is for the
+            narration, so joining them with ". " gives the script.
+    """
+    prompt = script_prompt(video_subject, paragraph_number, voice, custom_prompt)
+    cache_key = response_cache_key(prompt, model)
+    cached = REQUEST_CACHE.get(cache_key, namespace="llm")
+    if cached is not None:
+        yield from (sentence for sentence in clean_script(cached, paragraph_number).split(". ") if sentence)
+        return
+
+    def clean(lines: str) -> str:
+        # Remove markdown syntax
+        lines = re.sub(r"\[.*\]", "", lines)
+        return re.sub(r"\(.*\)", "", lines)
+
+    def settled(text: str) -> str:
+        # The start of the cleaned script that later tokens cannot change: the complete lines,
+        # and the last line up to its first bracket
+        complete, _, line = text.rpartition("\n")
+        brackets = [i for i in (line.find("["), line.find("(")) if i >= 0]
+        return clean(complete + _) + line[:min(brackets, default=len(line))]
+
+    stream = openai.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+    )
+    response = ""
+    text = ""
+    # The number of sentences split off so far, including empty ones
+    split = 0
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            response += delta
+            # Remove asterisks, hashes
+            text += delta.replace("*", "").replace("#", "")
+
+            # Stop at the end of the last paragraph that is used
+            paragraphs = text.split("\n\n")
+            complete = len(paragraphs) > paragraph_number
+            if complete:
+                text = "\n\n".join(paragraphs[:paragraph_number])
+                break
+
+            # The last sentence may still go on
+            sentences = settled(text).split(". ")[:-1]
+            for sentence in sentences[split:]:
+                if sentence:
+                    yield sentence
+            split = max(split, len(sentences))
+    finally:
+        stream.close()
+
+    for sentence in clean(text).split(". ")[split:]:
+        if sentence:
+            yield sentence
 
-        return final_script
+    print(colored(response, "cyan"))
+    if response:
+        REQUEST_CACHE.set(cache_key, response, namespace="llm")
     else:
         print(colored("[-] GPT returned an empty response.", "red"))
-        return ""
 
 
 def get_search_terms(
@@ -268,3 +390,68 @@ def generate_metadata(
     keywords = get_search_terms(video_subject, 6, script, ai_model, target_path)
 
     return title, description, keywords
+
+
+class VideoPlan(BaseModel):
+    """
+    Everything the LLM writes for a video, requested at once by `generate_plan`.
+    """
+    model_config = ConfigDict(extra="forbid")
+
+    script: str = Field(min_length=1)
+    search_terms: List[str] = Field(min_length=1)
+    title: str
+    description: str
+    keywords: List[str]
+
+
+def generate_plan(
+    video_subject: str,
+    paragraph_number: int,
+    voice: str,
+    model: str,
+    amount: int,
+    custom_prompt: str = "",
+) -> VideoPlan | None:
+    """
+    Generate the script, search terms and YouTube metadata of a video in a single request,
+    instead of one request each.
+
+    Args:
+        video_subject (str): The subject of the video.
+        paragraph_number (int): The number of paragraphs of the script.
+        voice (str): The voice the script is read in.
+        model (str): The AI model to use for generation.
+        amount (int): The amount of search terms to generate.
+        custom_prompt (str): Optional. A custom prompt to use for the script.
+
+    Returns:
+        VideoPlan | None: The plan with a cleaned script, None if the model did not answer
+            with a valid plan, so the separate requests can be made instead.
+    """
+    prompt = script_prompt(video_subject, paragraph_number, voice, custom_prompt) + f"""
+    The instructions above are for the "script" field of your answer. Besides the script, also generate {amount} search terms for stock videos that fit the script,
+    each consisting of 1-3 words and always including the main subject of the video, a catchy
+    and SEO-friendly title, a brief and engaging description and 6 keywords for a YouTube shorts
+    video of the script.
+
+    YOU MUST ONLY RETURN A JSON OBJECT THAT MATCHES THIS JSON SCHEMA:
+    {json.dumps(VideoPlan.model_json_schema())}
+    """
+
+    try:
+        response = generate_response(prompt, model, json_mode=True)
+        plan = VideoPlan.model_validate_json(response or "")
+    except (openai.OpenAIError, ValidationError) as e:
+        print(colored(f"[-] Could not generate a structured plan: {e}", "yellow"))
+        return None
+
+    plan.script = clean_script(plan.script, paragraph_number)
+    print(colored(plan.script, "cyan"))
+    print(
+        colored(
+            f"\nGenerated {len(plan.search_terms)} search terms: {', '.join(plan.search_terms)}",
+            "cyan",
+        )
+    )
+    return plan
@@ -0,0 +1,153 @@
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+from decouple import config
+from moviepy.config import get_setting
+
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken
+from backend.MediaStore import MediaStore
+from backend.ffmpeg_render import run_ffmpeg
+
+# Disk quota of the normalized clip store shared by all projects, 0 means unlimited
+NORMALIZED_STORE_MAX_BYTES = config("NORMALIZED_STORE_MAX_BYTES", default=10 * 1024**3, cast=int)
+
+NORMALIZED_STORE = MediaStore(Path("./cache/normalized"), max_bytes=NORMALIZED_STORE_MAX_BYTES)
+
+# Threads per transcode, the pool runs as many transcodes as it takes to occupy every core
+THREADS_PER_CLIP = config("NORMALIZE_THREADS_PER_CLIP", default=2, cast=int)
+
+# Shared by all projects, so concurrent jobs do not oversubscribe the cores
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 1) // THREADS_PER_CLIP),
+    thread_name_prefix="normalize",
+)
+
+
+@dataclass(frozen=True)
+class ClipProfile:
+    """
+    The uniform intermediate format stock clips are transcoded to before they are combined.
+
+    Only the first `max_duration` seconds of a clip are ever shown, so nothing after that is
+    transcoded. Keyframes every second keep seeking in the intermediate cheap.
+    """
+    width: int = 1080
+    height: int = 1920
+    fps: int = 30
+    preset: str = "veryfast"
+    crf: int = 18
+    max_duration: float = 5
+
+    @property
+    def key(self) -> str:
+        return f"{self.width}x{self.height}_{self.fps}fps_{self.preset}_crf{self.crf}_{self.max_duration}s"
+
+
+def fingerprint(path: Path, sample_size: int = 1024 * 1024) -> str:
+    """
+    Identifies a file by its size and the first and last megabyte of its content, which is
+    enough to tell stock videos apart without hashing them completely.
+    """
+    size = path.stat().st_size
+    h = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            h.update(f.read(sample_size))
+    return h.hexdigest()[:32]
+
+
+def normalize_command(source: Path, target: Path, profile: ClipProfile, threads: int) -> List[str]:
+    w, h = profile.width, profile.height
+    return [
+        get_setting("FFMPEG_BINARY"), "-y", "-hide_banner", "-loglevel", "error",
+        "-t", str(profile.max_duration),
+        "-i", str(source),
+        "-an",
+        "-vf", f"crop='min(iw,ih*{w}/{h})':'min(ih,iw*{h}/{w})',scale={w}:{h},fps={profile.fps},setsar=1",
+        "-c:v", "libx264",
+        "-preset", profile.preset,
+        "-crf", str(profile.crf),
+        "-pix_fmt", "yuv420p",
+        "-g", str(profile.fps),
+        "-threads", str(threads),
+        "-movflags", "+faststart",
+        str(target),
+    ]
+
+
+class ClipNormalizer:
+    """
+    Transcodes stock clips to a ClipProfile in the background, as soon as each one is submitted.
+
+    Every transcode is an ffmpeg process, so the shared pool only has to keep enough of them
+    running to occupy the available cores. Results are stored per (clip, profile) in a shared
+    store, so a clip that was normalized before, for any project, is linked instead of transcoded.
+
+    Args:
+        profile (ClipProfile): The format to transcode to.
+        cancel_token (CancellationToken): Optional. Kills running transcodes when cancelled.
+        store (MediaStore): The store normalized clips are kept in.
+    """
+
+    def __init__(
+        self,
+        profile: ClipProfile = ClipProfile(),
+        cancel_token: CancellationToken | None = None,
+        store: MediaStore = NORMALIZED_STORE,
+    ):
+        self.profile = profile
+        self.cancel_token = cancel_token or CancellationToken()
+        self.store = store
+        self._futures: dict[Path, Future] = {}
+
+    def _transcode(self, source: Path, target: Path) -> Path:
+        self.cancel_token.raise_if_cancelled()
+        partial = target.with_name(f"{target.stem}.part{target.suffix}")
+        try:
+            run_ffmpeg(
+                normalize_command(source, partial, self.profile, THREADS_PER_CLIP),
+                target.with_suffix(".log"),
+                self.cancel_token,
+            )
+            partial.replace(target)
+        finally:
+            partial.unlink(missing_ok=True)
+        return target
+
+    def _normalize(self, source: Path, target: Path) -> Path:
+        if target.exists():
+            return target
+        key = f"{fingerprint(source)}_{self.profile.key}"
+        normalized = self.store.fetch(key, target, lambda path: self._transcode(source, path))
+        LOGGER.debug(f"Normalized '{source}' into '{normalized}'.")
+        return normalized
+
+    def submit(self, source: Path, target: Path) -> Future:
+        """
+        Start normalizing a clip into the target path, unless that target was submitted before.
+        """
+        if target in self._futures:
+            return self._futures[target]
+        future = EXECUTOR.submit(self._normalize, source, target)
+        self._futures[target] = future
+        return future
+
+    def results(self) -> List[Path]:
+        """
+        Wait for every submitted clip and return the normalized clips ordered by path, which
+        does not depend on the order in which they were submitted.
+        """
+        try:
+            return [self._futures[target].result() for target in sorted(self._futures)]
+        except BaseException:
+            # Do not leave transcodes of a failed project queued in front of other projects
+            for future in self._futures.values():
+                future.cancel()
+            raise
@@ -1,13 +1,23 @@
 
 import hashlib
 import json
+import random
+from concurrent.futures import Future, wait
+from functools import cached_property
 from pathlib import Path
-from typing import List
-from uuid import uuid4
+from threading import BoundedSemaphore
+from typing import Callable, List
 
-from backend import LOGGER, gpt
+from decouple import config
+
+from backend import LOGGER, gpt, transcription
+from backend.audio import AudioManifest, concat_mp3
+from backend.CancellationToken import CancellationToken, OperationCancelled
+from backend.EncoderProfile import ENCODER_PROFILES, EncoderProfile
 from backend.project.ProjectConfig import ProjectConfig
-from backend.search import get_stock_video
+from backend.project.StageGraph import Stage, StageGraph
+from backend.normalize import ClipNormalizer, ClipProfile
+from backend.search import fetch_stock_videos
 
 from moviepy.editor import (
     AudioFileClip,
@@ -16,11 +26,23 @@ from moviepy.editor import (
     CompositeAudioClip,
 )
 
-from backend.tiktokvoice import tts
-from backend.video import combine_videos, generate_subtitles, generate_video
+from backend.tiktokvoice import TTSClient, iter_packs, pack_sentences, pack_text
+from backend import ffmpeg_render
+from backend.video import combine_videos, generate_subtitles, generate_video, plan_timeline, probe_duration
+from resources.resources import SONGS
 
 AMOUNT_OF_STOCK_VIDEOS = 5
 
+# The longest a single video is shown before the next one, when the videos are combined
+MAX_CLIP_DURATION = 5
+
+RENDER_BACKENDS = ("moviepy", "ffmpeg")
+
+# Encodes are CPU bound while the other stages mostly wait on APIs and downloads, so more jobs
+# than this may run at once and only their encodes take turns
+MAX_CONCURRENT_ENCODES = config("MAX_CONCURRENT_ENCODES", default=2, cast=int)
+ENCODE_SLOTS = BoundedSemaphore(max(1, MAX_CONCURRENT_ENCODES))
+
 def parse_json(json_data: dict) -> ProjectConfig:
     """
     Parse a JSON object into a ProjectConfig object.
@@ -36,6 +58,11 @@ def parse_json(json_data: dict) -> ProjectConfig:
         color=json_data.get("color", "Yellow"),
         useMusic=bool(json_data.get("useMusic", False)),
         automateYoutubeUpload=bool(json_data.get("automateYoutubeUpload", False)),
+        renderBackend=json_data.get("renderBackend", "moviepy"),
+        normalizeClips=bool(json_data.get("normalizeClips", True)),
+        encoderProfile=json_data.get("encoderProfile", "final"),
+        structuredOutput=bool(json_data.get("structuredOutput", False)),
+        streamScript=bool(json_data.get("streamScript", False)),
     )
 
 
@@ -50,14 +77,29 @@ class AIVideoProject:
     _initialized: bool = False
     script: str
     search_terms: list[str]
+    _clips: list[Path] | None = None
+    _transcript: transcription.PendingTranscript | None = None
+    # The TTS requests started while the script was streamed, and the client that sent them
+    _tts_client: TTSClient | None = None
+    _prefetched: list[Future] = []
+    stage_timings: dict[str, float]
+    stage_waits: dict[str, float]
     _subdirs = {
         "video": "video",
         "output": "output",
         "audio_parts": "audio_parts",
+        "normalized": "normalized",
     }
     
-    def __init__(self,request_data:dict):
+    def __init__(self,request_data:dict, cancel_token: CancellationToken | None = None):
         self.config = parse_json(request_data)
+        if self.config.renderBackend not in RENDER_BACKENDS:
+            raise ValueError(f"Unknown render backend '{self.config.renderBackend}', expected one of {RENDER_BACKENDS}.")
+        if self.config.encoderProfile not in ENCODER_PROFILES:
+            raise ValueError(
+                f"Unknown encoder profile '{self.config.encoderProfile}', expected one of {tuple(ENCODER_PROFILES)}."
+            )
+        self.cancel_token = cancel_token or CancellationToken()
         self.project_id = hashlib.sha256(self.config.videoSubject.encode()).hexdigest()
         self.init()
     
@@ -81,6 +123,11 @@ class AIVideoProject:
             "color": self.config.color,
             "useMusic": self.config.useMusic,
             "automateYoutubeUpload": self.config.automateYoutubeUpload,
+            "renderBackend": self.config.renderBackend,
+            "normalizeClips": self.config.normalizeClips,
+            "encoderProfile": self.config.encoderProfile,
+            "structuredOutput": self.config.structuredOutput,
+            "streamScript": self.config.streamScript,
         }
 
         self.save_metadata()
@@ -101,18 +148,75 @@ class AIVideoProject:
             return self._project_dir / subdir
         return None
         
+    def _discard(self, paths) -> None:
+        """
+        Remove partial outputs left behind by a cancelled stage.
+        """
+        for path in list(paths):
+            Path(path).unlink(missing_ok=True)
+        LOGGER.info(f"Discarded partial outputs of cancelled project '{self.project_id}'.")
+
     @property
     def root(self)->Path:
         return self._project_dir
 
 
+    @property
+    def profile(self) -> EncoderProfile:
+        return ENCODER_PROFILES[self.config.encoderProfile]
+
+    def profile_dir(self, subdir: str) -> Path:
+        """
+        The directory of a subdir that holds outputs of the encoder profile. Everything before
+        the clips are normalized is shared, so a draft can be promoted to a final render that
+        only has to normalize, combine and render again. The final profile keeps the plain
+        subdir, so projects rendered before profiles existed are still found.
+        """
+        path = self.get_subdir(subdir)
+        if self.profile.name != "final":
+            path = path / self.profile.name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    @property
+    def final_video_path(self) -> Path:
+        return self.profile_dir("output") / "final.mp4"
+
     @property
     def videos(self)->list[Path]:
-        return list((self.root/"video").glob("*.mp4"))
+        return sorted((self.root/"video").glob("*.mp4"))
 
     @property
-    def audio_parts(self)->List[AudioFileClip]:
-        return [AudioFileClip(str(p)) for p in (self.root / "audio_parts").glob("*.mp3")]
+    def clips(self) -> list[Path]:
+        """
+        The videos to combine, normalized if the normalize stage has run.
+        """
+        return self._clips if self._clips is not None else self.videos
+
+    @cached_property
+    def music_path(self) -> Path | None:
+        """
+        The song to play under the narration, picked once per project.
+        """
+        if not self.config.useMusic or len(SONGS) == 0:
+            return None
+        return Path(random.choice(SONGS))
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.root / "audio_parts" / "manifest.json"
+
+    @cached_property
+    def manifest(self) -> AudioManifest:
+        """
+        The narration parts with their durations, written when the narration is synthesized.
+        """
+        if not self.manifest_path.exists():
+            # Projects synthesized before manifests existed, parts are numbered by sentence
+            paths = sorted((self.root / "audio_parts").glob("*.mp3"), key=lambda p: int(p.stem))
+            packs = [[sentence] for sentence in self.get_sentences()]
+            AudioManifest.from_parts(paths, packs).save(self.manifest_path)
+        return AudioManifest.load(self.manifest_path)
 
 
     def generate_script(self):
@@ -123,6 +227,12 @@ class AIVideoProject:
 
         src = self.config.aiModel if not script_path.exists() else f"file: '{script_path}'"
 
+        if not script_path.exists() and self.config.structuredOutput:
+            self._generate_plan()
+
+        if not script_path.exists() and self.config.streamScript:
+            self._stream_script()
+
         if not script_path.exists():
             script = gpt.generate_script(
                 custom_prompt=self.config.customPrompt,
@@ -140,6 +250,64 @@ class AIVideoProject:
 
         return self.script
 
+    def _generate_plan(self) -> None:
+        """
+        Generate the script, search terms and YouTube metadata with a single request. If the model
+        does not answer with a valid plan nothing is written, and they are generated separately.
+        """
+        plan = gpt.generate_plan(
+            video_subject=self.config.videoSubject,
+            paragraph_number=self.config.paragraphNumber,
+            voice=self.config.voice,
+            model=self.config.aiModel,
+            amount=AMOUNT_OF_STOCK_VIDEOS,
+            custom_prompt=self.config.customPrompt,
+        )
+        if plan is None:
+            LOGGER.warning(f"No structured plan for '{self.config.videoSubject}', generating it step by step.")
+            return
+
+        # The script is written last, it marks the plan as complete
+        with open(self._project_dir / "search_terms.json", "w") as f:
+            json.dump(plan.search_terms, indent=4, fp=f)
+        with open(self._project_dir / "youtube_metadata.json", "w") as f:
+            json.dump({"title": plan.title, "description": plan.description, "keywords": plan.keywords}, indent=4, fp=f)
+        with open(self._project_dir / ".script", "w") as f:
+            f.write(plan.script)
+        LOGGER.info(f"Script, search terms and metadata generated with a single request for '{self.config.videoSubject}'.")
+
+    def _stream_script(self) -> None:
+        """
+        Generate the script while synthesizing it. Sentences are packed and sent to TTS as soon
+        as the model has written them, so the tts stage mostly finds its parts in the store.
+        """
+        sentences = []
+
+        def generated():
+            for sentence in gpt.stream_script(
+                video_subject=self.config.videoSubject,
+                paragraph_number=self.config.paragraphNumber,
+                voice=self.config.voice,
+                model=self.config.aiModel,
+                custom_prompt=self.config.customPrompt,
+            ):
+                self.cancel_token.raise_if_cancelled()
+                sentences.append(sentence)
+                yield sentence
+
+        # Packed the same way generate_tts packs the finished script, so it requests the same texts
+        self._tts_client = TTSClient(self.config.voice, cancel_token=self.cancel_token)
+        texts = (pack_text(pack) for pack in iter_packs(generated()))
+        try:
+            self._prefetched = self._tts_client.prefetch(texts)
+        except BaseException:
+            self._tts_client.close()
+            raise
+
+        with open(self._project_dir / ".script", "w") as f:
+            f.write(". ".join(sentences))
+        LOGGER.info(f"Script streamed into {len(self._prefetched)} TTS requests for '{self.config.videoSubject}'.")
+
     def get_search_terms(self)->list[str]:
         """
         Generate search terms for the project.
@@ -161,13 +329,12 @@ class AIVideoProject:
         LOGGER.info(f"Search terms obtained from '{search_terms_path}'.")
         return self.search_terms
         
-    def download_videos(self) -> List[Path]:
+    def download_videos(self, on_downloaded: Callable[[Path], None] | None = None) -> List[Path]:
         """
-        Search for a video of the given search term and download them to the target path.
+        Search for a video for every search term and download them into the project, all at once.
 
         Args:
-            search_terms (List[str]): The search terms to search for.
-            target_path (Path): The path to save the videos to.
+            on_downloaded (Callable[[Path], None]): Optional. Called with every video as soon as it has been saved.
 
         Returns:    
             List[Path]: A list of paths to the saved videos. 
@@ -175,21 +342,29 @@ class AIVideoProject:
         if  len(self.videos) > 0:
             return self.videos
         
-        video_results = []
-
         # Defines how many results it should query and search through
         it = 15
 
         # Defines the minimum duration of each clip
         min_dur = 10
-        saved_urls = []
-        # Loop through all search terms, and search for a video of the given search term.
-        for search_term in self.search_terms:
-            video = get_stock_video(search_term, it, min_dur, saved_urls)
-            if video:
-                vidfile = video.save(self.root/"video"/f"{uuid4()}.mp4")
-                video_results.append(vidfile)
-                saved_urls.append(video.id)
+
+        # Every video is shown for an equal share of the narration, but never longer than a clip.
+        # The narration is usually synthesized while the videos download, so its duration is
+        # only known on a re-run
+        target_duration = MAX_CLIP_DURATION
+        if self.search_terms and self.manifest_path.exists():
+            target_duration = min(target_duration, self.manifest.duration / len(self.search_terms))
+        try:
+            video_results = fetch_stock_videos(
+                self.search_terms, it, min_dur, self.root/"video",
+                cancel_token=self.cancel_token,
+                target_duration=target_duration,
+                on_downloaded=on_downloaded,
+            )
+        except OperationCancelled:
+            # A partial set of videos would be mistaken for a finished download on the next run
+            self._discard(self.videos)
+            raise
         LOGGER.info(f"Videos downloaded from pexels api for '{self.config.videoSubject}'.")
         return video_results
 
@@ -197,27 +372,55 @@ class AIVideoProject:
         if not self.script:
             raise Exception("Cannot generate TTS, script not generated")
         sentences = self.get_sentences()
-        audio_paths = []
-
+        parts_dir = self.root / "audio_parts"
         tts_path = self.root / "tts.mp3"
-                
-        if len(self.audio_parts) == 0:
-            # Generate TTS for every sentence
-            for i, sentence in enumerate(sentences):
-                current_tts_path = self.root / "audio_parts"
-                audio_part = tts(
-                    sentence, self.config.voice, audio_parts=current_tts_path, i=i
-                )
-                audio_clip = AudioFileClip(str(audio_part))
-                audio_paths.append(audio_clip)
 
-        # Combine all TTS files using moviepy
-        if not tts_path.exists():
-            final_audio = concatenate_audioclips(audio_paths)
-            final_audio.write_audiofile(tts_path)
+        client = self._tts_client or TTSClient(self.config.voice, cancel_token=self.cancel_token)
+        try:
+            # The requests started while the script was streamed fill the store, they have to
+            # finish before the parts are linked from it
+            pending = set(self._prefetched)
+            while pending:
+                _, pending = wait(pending, timeout=0.25)
+                self.cancel_token.raise_if_cancelled()
+
+            if not tts_path.exists():
+                # Consecutive sentences share a request up to the length limit, the pauses between
+                # them are found in the audio afterwards to time the subtitles of each sentence
+                packs = pack_sentences(sentences)
+                texts = [pack_text(pack) for pack in packs]
+
+                # Synthesize every part at once. Parts are written atomically, so the parts of a
+                # cancelled or interrupted run are complete and reused by the next one
+                part_paths = client.synthesize_all(texts, parts_dir)
+                AudioManifest.from_parts(part_paths, packs, texts).save(self.manifest_path)
+                LOGGER.info(f"Synthesized {len(sentences)} sentences in {len(packs)} parts.")
+
+                try:
+                    # The parts come from the same service in the same voice, so their frames can
+                    # be copied back to back without decoding them
+                    concat_mp3(part_paths, tts_path)
+                except ValueError as e:
+                    LOGGER.warning(f"{e} Decoding them instead.")
+                    self._concatenate_decoded(part_paths, tts_path)
+        finally:
+            client.close()
         self.tts_path = tts_path
-        
 
+        # Start transcribing right away, the subtitles stage only waits for the result
+        if transcription.enabled() and not (self.root / "subtitles.srt").exists():
+            self._transcript = transcription.PendingTranscript(tts_path, self.config.voice[:2])
+
+    def _concatenate_decoded(self, part_paths: List[Path], tts_path: Path) -> None:
+        audio_clips = [AudioFileClip(str(p)) for p in part_paths]
+        partial = tts_path.with_name(f"{tts_path.stem}.part{tts_path.suffix}")
+        try:
+            concatenate_audioclips(audio_clips).write_audiofile(str(partial))
+            partial.replace(tts_path)
+        finally:
+            partial.unlink(missing_ok=True)
+            for audio_clip in audio_clips:
+                audio_clip.close()
 
     def get_sentences(self):
         sentences = self.script.split(". ")
@@ -230,40 +433,174 @@ class AIVideoProject:
         if not subtitles_path.exists():
                 generate_subtitles(
                     audio_path=self.tts_path,
-                    sentences=self.get_sentences(),
-                    audio_clips=self.audio_parts,
+                    manifest=self.manifest,
                     voice= self.config.voice[:2],
                     target=subtitles_path,
+                    transcript=self._transcript,
+                    cancel_token=self.cancel_token,
                 )
         with open(subtitles_path, "r") as f:
             self.subtitles = f.read()
         LOGGER.info(f"Subtitles obtained from '{subtitles_path}'.")
         return self.subtitles
 
-    def make_final_video(self):
-        combined_video_path = self.root / "output" / "combined.mp4"
+    def combine_videos(self) -> Path:
+        """
+        Concatenate the downloaded videos into a clip as long as the narration.
+        """
+        combined_video_path = self.profile_dir("output") / "combined.mp4"
         if not combined_video_path.exists():
             # Concatenate videos
-            temp_audio = AudioFileClip(str(self.tts_path))
             combined_video_path = combine_videos(
-                self.videos,
-                temp_audio.duration,
-                5,
+                self.clips,
+                self.manifest.duration,
+                MAX_CLIP_DURATION,
                 self.config.threads,
-                combined_video_path
+                combined_video_path,
+                cancel_token=self.cancel_token,
+                profile=self.profile,
             )
         LOGGER.info(f"Videos combined into '{combined_video_path}'.")
+        return Path(combined_video_path)
 
-        # Put everything together        
+    def render(self) -> Path:
+        """
+        Burn the subtitles and narration into the combined video.
+        """
         final_video_path = generate_video(
-                str(combined_video_path),
+                str(self.profile_dir("output") / "combined.mp4"),
                 str(self.tts_path),
                 str(self.root / "subtitles.srt"),
                 self.config.threads,
                 self.config.subtitlesPosition,
                 self.config.color,
-            target=self.root / "output" / "final.mp4",
+            target=self.final_video_path,
+            cancel_token=self.cancel_token,
+            music_path=self.music_path,
+            profile=self.profile,
         )
         LOGGER.info(f"Final video generated into '{final_video_path}'.")
 
         return final_video_path
+
+    def render_ffmpeg(self) -> Path:
+        """
+        Cut, subtitle and mix the final video in a single ffmpeg encode, skipping the
+        intermediate combined video of the moviepy backend.
+        """
+        timeline = plan_timeline(
+            [(path, probe_duration(path)) for path in self.clips],
+            self.manifest.duration,
+            MAX_CLIP_DURATION,
+        )
+        final_video_path = ffmpeg_render.render_video(
+            timeline,
+            self.tts_path,
+            self.manifest.duration,
+            self.root / "subtitles.srt",
+            self.config.threads,
+            self.config.subtitlesPosition,
+            self.config.color,
+            target=self.final_video_path,
+            music_path=self.music_path,
+            cancel_token=self.cancel_token,
+            prenormalized=self.config.normalizeClips,
+            profile=self.profile,
+        )
+        LOGGER.info(f"Final video rendered with ffmpeg into '{final_video_path}'.")
+
+        return final_video_path
+
+    def make_final_video(self):
+        self.combine_videos()
+        return self.render()
+
+    def artifacts(self) -> dict[str, str | list[str]]:
+        """
+        Collect the paths of every artifact the project has produced so far.
+        """
+        candidates = {
+            "script": self.root / ".script",
+            "searchTerms": self.root / "search_terms.json",
+            "youtubeMetadata": self.root / "youtube_metadata.json",
+            "tts": self.root / "tts.mp3",
+            "subtitles": self.root / "subtitles.srt",
+            "combined": self.profile_dir("output") / "combined.mp4",
+            "final": self.final_video_path,
+        }
+        artifacts: dict[str, str | list[str]] = {
+            name: str(path) for name, path in candidates.items() if path.exists()
+        }
+        if len(self.videos) > 0:
+            artifacts["videos"] = [str(p) for p in self.videos]
+        return artifacts
+
+    def _normalize_clip(self, video_path: Path) -> None:
+        self._normalizer.submit(video_path, self.profile_dir("normalized") / video_path.name)
+
+    def _download_stage(self) -> List[Path]:
+        if not self.config.normalizeClips:
+            video_paths = self.download_videos()
+        else:
+            # Start normalizing every video as soon as it is downloaded
+            # Clips are normalized to the size and frame rate of the output, a draft transcodes a
+            # quarter of the pixels
+            clip_profile = ClipProfile(width=self.profile.width, height=self.profile.height, fps=self.profile.fps)
+            self._normalizer = ClipNormalizer(clip_profile, cancel_token=self.cancel_token)
+            video_paths = self.download_videos(on_downloaded=self._normalize_clip)
+            for video_path in self.videos:
+                # Videos from an earlier run were not downloaded now, submitting again is a no-op
+                self._normalize_clip(video_path)
+        if len(self.videos) == 0:
+            raise Exception("No videos found to download on pexels api.")
+        return video_paths
+
+    def normalize_videos(self) -> List[Path]:
+        """
+        Wait for the downloaded videos to be transcoded to the uniform intermediate format.
+        """
+        if self.config.normalizeClips:
+            self._clips = self._normalizer.results()
+            LOGGER.info(f"Normalized {len(self._clips)} videos for '{self.config.videoSubject}'.")
+        return self.clips
+
+    def stages(self) -> List[Stage]:
+        """
+        Describe the pipeline as a dependency graph. The stock footage branch (search terms and
+        downloads) and the narration branch (TTS and subtitles) only share the script, so they
+        run side by side and join when the videos are combined.
+        """
+        stages = [
+            Stage("script", self.generate_script),
+            Stage("search_terms", self.get_search_terms, ["script"]),
+            Stage("download", self._download_stage, ["search_terms"]),
+            Stage("tts", self.generate_tts, ["script"]),
+            Stage("subtitles", self.get_subtitles, ["tts"]),
+            Stage("normalize", self.normalize_videos, ["download"]),
+        ]
+        if self.config.renderBackend == "ffmpeg":
+            return stages + [
+                Stage("render", self.render_ffmpeg, ["normalize", "tts", "subtitles"], slots=ENCODE_SLOTS),
+            ]
+        return stages + [
+            Stage("combine", self.combine_videos, ["normalize", "tts"], slots=ENCODE_SLOTS),
+            Stage("render", self.render, ["combine", "subtitles"], slots=ENCODE_SLOTS),
+        ]
+
+    def run(self, on_stage: Callable[[str, str], None] | None = None) -> Path:
+        """
+        Run every stage of the project and return the path to the final video.
+
+        Args:
+            on_stage (Callable[[str, str], None]): Optional. Called with the name of a stage and its
+                new state ("running", "done" or "failed").
+
+        Returns:
+            Path: The path to the final video.
+        """
+        graph = StageGraph(self.stages(), cancel_token=self.cancel_token)
+        # Filled in as stages finish, so it can be read from on_stage
+        self.stage_timings = graph.timings
+        self.stage_waits = graph.waits
+        results = graph.run(on_stage=on_stage)
+        return results["render"]
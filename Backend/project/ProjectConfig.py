@@ -14,5 +14,10 @@ class ProjectConfig:
     useMusic: bool = False
     automateYoutubeUpload: bool = False
     customPrompt: str = ""
+    renderBackend: str = "moviepy"
+    normalizeClips: bool = True
+    encoderProfile: str = "final"
+    structuredOutput: bool = False
+    streamScript: bool = False
 
    
\ No newline at end of file
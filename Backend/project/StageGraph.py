@@ -0,0 +1,136 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from threading import Semaphore
+from typing import Any, Callable
+
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken
+
+
+@dataclass
+class Stage:
+    """
+    A unit of work in a project pipeline that may only start once its dependencies are done,
+    and, if it has `slots`, once it holds one of them.
+    """
+    name: str
+    fn: Callable[[], Any]
+    depends_on: list[str] = field(default_factory=list)
+    slots: Semaphore | None = None
+
+
+class StageGraph:
+    """
+    Runs a set of stages as a dependency graph, starting every stage as soon as its
+    dependencies have finished so that independent branches run at the same time.
+
+    Args:
+        stages (list[Stage]): The stages of the graph.
+        cancel_token (CancellationToken): Optional. Stops scheduling new stages once cancelled, and is
+            cancelled by the graph when a stage fails so that stages on other branches stop early.
+    """
+
+    def __init__(self, stages: list[Stage], cancel_token: CancellationToken | None = None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cancel_token = cancel_token or CancellationToken()
+        self.results: dict[str, Any] = {}
+        # The seconds every stage worked, and the seconds stages with slots waited for one before
+        self.timings: dict[str, float] = {}
+        self.waits: dict[str, float] = {}
+        self._validate()
+
+    def _validate(self) -> None:
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dependency}'.")
+
+        # Kahn's algorithm, any stage left over is part of a cycle
+        remaining = {name: set(stage.depends_on) for name, stage in self.stages.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Stages {sorted(remaining)} contain a dependency cycle.")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(
+        self,
+        on_stage: Callable[[str, str], None] | None = None,
+        max_workers: int = 3,
+    ) -> dict[str, Any]:
+        """
+        Execute the graph and return the result of every stage.
+
+        Args:
+            on_stage (Callable[[str, str], None]): Optional. Called with a stage name and its new
+                state ("running", "done" or "failed").
+            max_workers (int): The number of stages that may run at the same time.
+
+        Returns:
+            dict[str, Any]: The return value of each stage by name.
+        """
+        def notify(name: str, state: str) -> None:
+            if on_stage:
+                on_stage(name, state)
+
+        def execute(stage: Stage) -> Any:
+            if stage.slots is None:
+                return timed(stage)
+            started = time.perf_counter()
+            while not stage.slots.acquire(timeout=0.25):
+                self.cancel_token.raise_if_cancelled()
+            self.waits[stage.name] = time.perf_counter() - started
+            try:
+                self.cancel_token.raise_if_cancelled()
+                return timed(stage)
+            finally:
+                stage.slots.release()
+
+        def timed(stage: Stage) -> Any:
+            started = time.perf_counter()
+            try:
+                return stage.fn()
+            finally:
+                self.timings[stage.name] = time.perf_counter() - started
+
+        pending = dict(self.stages)
+        running: dict[Future, str] = {}
+        error: BaseException | None = None
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+            while pending or running:
+                if error is None and not self.cancel_token.cancelled:
+                    ready = [
+                        stage for stage in pending.values()
+                        if all(dependency in self.results for dependency in stage.depends_on)
+                    ]
+                    for stage in ready:
+                        del pending[stage.name]
+                        notify(stage.name, "running")
+                        running[executor.submit(execute, stage)] = stage.name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        notify(name, "done")
+                        LOGGER.debug(f"Stage '{name}' finished in {self.timings[name]:.2f}s.")
+                    except BaseException as e:
+                        notify(name, "failed")
+                        # Keep the first error, later ones are usually consequences of it
+                        if error is None:
+                            error = e
+                            self.cancel_token.cancel()
+
+        if error is not None:
+            raise error
+        self.cancel_token.raise_if_cancelled()
+        return self.results
@@ -1,12 +1,61 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, List
 from termcolor import colored
 from decouple import config
 
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken
+from backend.MediaStore import MediaStore
+from backend.RequestCache import REQUEST_CACHE
+
 PEXELS_API_KEY = config("PEXELS_API_KEY")
 
+# Maximum number of concurrent requests to pexels, also the size of the connection pool
+MAX_WORKERS = config("PEXELS_MAX_WORKERS", default=5, cast=int)
+
+# Size stock videos are cropped and resized to
+TARGET_SIZE = (1080, 1920)
+
+# Maximum download speed per video in bytes per second, 0 means unlimited
+DOWNLOAD_RATE_LIMIT = config("PEXELS_DOWNLOAD_RATE_LIMIT", default=0, cast=int)
+
+# Size of the chunks videos are streamed to disk in
+CHUNK_SIZE = 1024 * 1024
+
+# Disk quota of the stock video store shared by all projects, 0 means unlimited
+MEDIA_STORE_MAX_BYTES = config("MEDIA_STORE_MAX_BYTES", default=20 * 1024**3, cast=int)
+
+MEDIA_STORE = MediaStore(Path("./cache/media"), max_bytes=MEDIA_STORE_MAX_BYTES)
+
+# Shared session so searches and downloads reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+
+
+class ProgressReporter:
+    """
+    Logs the progress of a download every time another tenth of it has arrived.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._reported = -1
+
+    def __call__(self, downloaded: int, total: int | None) -> None:
+        if not total:
+            return
+        step = downloaded * 10 // total
+        if step > self._reported:
+            self._reported = step
+            LOGGER.debug(f"Downloading '{self.name}': {downloaded / total:.0%} of {total / 1e6:.1f} MB.")
+
+
 @dataclass
 class VideoResult:
     id: str
@@ -20,21 +69,228 @@ class VideoResult:
     
     def __repr__(self):
         return self.__str__()
+
+    @property
+    def key(self) -> str:
+        """
+        Identifies this exact file of the video, used as the media store key.
+        """
+        return f"pexels_{self.id}_{self.width}x{self.height}"
     
     
-    def save(self, target_path: Path) -> Path|None:
+    def save(
+        self,
+        target_path: Path,
+        rate_limit: int | None = None,
+        on_progress: Callable[[int, int | None], None] | None = None,
+        cancel_token: CancellationToken | None = None,
+        max_retries: int = 3,
+    ) -> Path|None:
         """
             Saves a video to the local directory.
+
+            The file is streamed in chunks into `<target>.part` and renamed once complete, so memory
+            use does not depend on the size of the clip. When a `.part` file is left over from an
+            interrupted download, the download resumes from where it stopped using a Range request.
+
+            Args:
+                target_path (Path): The path to save the video to.
+                rate_limit (int): Optional. Maximum download speed in bytes per second, defaults to
+                    PEXELS_DOWNLOAD_RATE_LIMIT (0 means unlimited).
+                on_progress (Callable[[int, int | None], None]): Optional. Called with the bytes
+                    downloaded so far and the total size (if known) after every chunk.
+                cancel_token (CancellationToken): Optional. Aborts the download when cancelled.
+                max_retries (int): How often an interrupted download is resumed before giving up.
+
+            Returns:
+                Path: The path to the saved video, or None if the download failed.
         """
-        r = requests.get(self.url, timeout=10)
-        if r.status_code != 200:
-            print(colored(f"Saving video failed for url: '{self.url}' to '{target_path}'", "red"))
-            return None
-        
-        with target_path.open("wb") as f:
-            f.write(r.content)
-        return target_path
-  
+        rate_limit = DOWNLOAD_RATE_LIMIT if rate_limit is None else rate_limit
+        cancel_token = cancel_token or CancellationToken()
+        partial_path = target_path.with_name(target_path.name + ".part")
+
+        for attempt in range(max_retries + 1):
+            try:
+                if self._download(partial_path, rate_limit, on_progress, cancel_token):
+                    partial_path.replace(target_path)
+                    return target_path
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                print(colored(f"[-] Download of '{self.url}' interrupted ({e}), attempt {attempt + 1}/{max_retries + 1}.", "yellow"))
+
+        print(colored(f"Saving video failed for url: '{self.url}' to '{target_path}'", "red"))
+        return None
+
+    def _download(
+        self,
+        partial_path: Path,
+        rate_limit: int,
+        on_progress: Callable[[int, int | None], None] | None,
+        cancel_token: CancellationToken,
+    ) -> bool:
+        offset = partial_path.stat().st_size if partial_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+        with SESSION.get(self.url, headers=headers, stream=True, timeout=(10, 30)) as r:
+            if r.status_code == 416:
+                # The partial file does not match the remote file anymore, start over
+                partial_path.unlink(missing_ok=True)
+                return self._download(partial_path, rate_limit, on_progress, cancel_token)
+            if r.status_code not in (200, 206):
+                return False
+            if r.status_code == 200:
+                # The server ignored the Range header and sends the whole file
+                offset = 0
+
+            length = r.headers.get("Content-Length")
+            total = offset + int(length) if length is not None else None
+            downloaded = offset
+            received = 0
+            started = time.monotonic()
+
+            with partial_path.open("ab" if offset > 0 else "wb") as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    cancel_token.raise_if_cancelled()
+                    f.write(chunk)
+                    downloaded += len(chunk)
+                    received += len(chunk)
+                    if on_progress:
+                        on_progress(downloaded, total)
+                    if rate_limit > 0:
+                        # Sleep until the average speed of this download is back under the cap
+                        ahead = received / rate_limit - (time.monotonic() - started)
+                        if ahead > 0 and cancel_token.wait(ahead):
+                            cancel_token.raise_if_cancelled()
+
+        if total is not None and downloaded < total:
+            raise requests.exceptions.ChunkedEncodingError(f"Received {downloaded} of {total} bytes.")
+        return True
+
+
+def covers_target(width: int, height: int, target_size: tuple[int, int] = TARGET_SIZE) -> bool:
+    """
+    Checks whether a video is still at least as large as the target after it has been
+    center cropped to the aspect ratio of the target, the way combine_videos crops it.
+    """
+    target_w, target_h = target_size
+    ratio = target_w / target_h
+    if width / height < ratio:
+        crop_w, crop_h = width, width / ratio
+    else:
+        crop_w, crop_h = height * ratio, height
+    return round(crop_w) >= target_w and round(crop_h) >= target_h
+
+
+def select_video_file(video_files: List[dict], target_size: tuple[int, int] = TARGET_SIZE) -> dict | None:
+    """
+    Selects the smallest file of a video that still covers the target size after cropping,
+    or the largest file if none of them does. Anything larger is downloaded, decoded and
+    resized for nothing.
+    """
+    files = [f for f in video_files if ".com/video-files" in f["link"] and f["width"] and f["height"]]
+    covering = [f for f in files if covers_target(f["width"], f["height"], target_size)]
+    if covering:
+        return min(covering, key=lambda f: f["width"] * f["height"])
+    if files:
+        return max(files, key=lambda f: f["width"] * f["height"])
+    return None
+
+
+def _search_page(query: str, n: int, page: int, session: requests.Session) -> List[dict]:
+    # Build headers
+    headers = {
+        "Authorization": PEXELS_API_KEY
+    }
+    params = {"query": query, "per_page": n, "page": page}
+
+    # Identical searches are answered from the cache for a day
+    cache_key = json.dumps(params)
+    body = REQUEST_CACHE.get(cache_key, namespace="pexels")
+    if body is None:
+        # Send the request
+        r = session.get(
+            "https://api.pexels.com/videos/search",
+            params=params,
+            headers=headers,
+            timeout=10,
+        )
+        body = r.text
+        if r.status_code == 200:
+            REQUEST_CACHE.set(cache_key, body, namespace="pexels")
+
+    # Parse the response
+    return json.loads(body).get("videos", [])
+
+
+def search_stock_videos(
+    query: str,
+    n: int,
+    min_dur: int,
+    session: requests.Session | None = None,
+    target_size: tuple[int, int] = TARGET_SIZE,
+    target_duration: float | None = None,
+    min_candidates: int = 3,
+    max_pages: int = 3,
+) -> List[VideoResult]:
+    """
+    Searches for stock videos based on a query.
+
+    Videos whose best file covers the target size come first, then videos are ordered by how
+    closely their duration fits the target duration, and finally by search relevance. Further
+    result pages are only requested while fewer than `min_candidates` videos cover the target.
+
+    Args:
+        query (str): The query to search for.
+        n (int): The number of videos to search for per page.
+        min_dur (int): The minimum duration of the videos to search for.
+        session (requests.Session): Optional. The session to send the request with.
+        target_size (tuple[int, int]): The size videos are cropped and resized to.
+        target_duration (float): Optional. The clip length that is needed, defaults to `min_dur`.
+        min_candidates (int): The number of covering videos after which no more pages are searched.
+        max_pages (int): The maximum number of result pages to search.
+
+    Returns:
+        List[VideoResult]: The selected file of every long enough video, best fit first.
+    """
+    session = session or SESSION
+    target_duration = target_duration or min_dur
+
+    results = []
+    seen = set()
+    for page in range(1, max_pages + 1):
+        videos = _search_page(query, n, page, session)
+
+        # filter out videos that are less than the minimum duration
+        for video in filter(lambda x: x["duration"] >= min_dur and x["id"] not in seen, videos):
+            seen.add(video["id"])
+            video_file = select_video_file(video["video_files"], target_size)
+            if video_file is not None:
+                results.append(VideoResult(
+                    id=video["id"],
+                    url=video_file["link"],
+                    duration=video["duration"],
+                    width=video_file["width"],
+                    height=video_file["height"],
+                ))
+
+        covering = sum(covers_target(v.width, v.height, target_size) for v in results)
+        if covering >= min_candidates or len(videos) < n:
+            break
+
+    def rank(item: tuple[int, VideoResult]) -> tuple:
+        i, video = item
+        return (
+            not covers_target(video.width, video.height, target_size),
+            video.duration < target_duration,
+            abs(video.duration - target_duration),
+            i,
+        )
+
+    results = [video for _, video in sorted(enumerate(results), key=rank)]
+
+    print(colored(f"\t=> \"{query}\" found {len(results)} videos.", "cyan" if results else "red"))
+    return results
+
 
 def get_stock_video(query: str, n: int, min_dur: int, saved_urls: List[str]) -> VideoResult|None:
     """
@@ -44,57 +300,83 @@ def get_stock_video(query: str, n: int, min_dur: int, saved_urls: List[str]) ->
         query (str): The query to search for.
         n (int): The number of videos to search for.
         min_dur (int): The minimum duration of the videos to search for.
+        saved_urls (List[str]): The urls of videos that should not be returned again.
 
     Returns:
         VideoResult: A stock video or None if no video is found.
     """
-    
-    # Build headers
-    headers = {
-        "Authorization": PEXELS_API_KEY
-    }
+    for video in search_stock_videos(query, n, min_dur):
+        if video.url not in saved_urls:
+            return video
+    print(colored(f"[-] No videos found for query: '{query}'", "red"))
+    return None
 
-    # Build URL
-    qurl = f"https://api.pexels.com/videos/search?query={query}&per_page={n}"
 
-    # Send the request
-    r = requests.get(qurl, headers=headers,timeout=10)
+def fetch_stock_videos(
+    search_terms: List[str],
+    n: int,
+    min_dur: int,
+    target_dir: Path,
+    max_workers: int = MAX_WORKERS,
+    cancel_token: CancellationToken | None = None,
+    target_size: tuple[int, int] = TARGET_SIZE,
+    target_duration: float | None = None,
+    on_downloaded: Callable[[Path], None] | None = None,
+) -> List[Path]:
+    """
+    Searches for every search term at once and downloads one video per term in parallel.
 
-    # Parse the response
-    response = r.json()
-
-    # Parse each video    
-    result: VideoResult = None
-    video_res = 0
-    videos = response["videos"]
-    if len(videos) == 0:
-        print(colored(f"[-] No videos found for query: '{query}'", "red"))
-        return None
-    
-    # loop through each video in the result
-    for video in filter(lambda x: x["duration"] >= min_dur, videos): # filter out videos that are less than the minimum duration
-        video_files = video["video_files"]            
-        
-        best_url = ""
-
-        # loop through each url to determine the best quality
-        for video_file in video_files:
-            url = video_file["link"]
-            if url in saved_urls:
+    Every term gets the first search result that no earlier term already picked, so the
+    selection does not depend on which request finishes first.
+
+    Args:
+        search_terms (List[str]): The search terms to search for.
+        n (int): The number of videos to search through per term.
+        min_dur (int): The minimum duration of the videos.
+        target_dir (Path): The directory to save the videos to.
+        max_workers (int): The number of concurrent requests.
+        cancel_token (CancellationToken): Optional. Stops starting new requests once cancelled.
+        target_size (tuple[int, int]): The size videos are cropped and resized to.
+        target_duration (float): Optional. The clip length that is needed.
+        on_downloaded (Callable[[Path], None]): Optional. Called with every video as soon as it
+            has been saved, so processing can start before the other downloads are done.
+
+    Returns:
+        List[Path]: The saved videos, in search term order.
+    """
+    cancel_token = cancel_token or CancellationToken()
+
+    def search(query: str) -> List[VideoResult]:
+        cancel_token.raise_if_cancelled()
+        return search_stock_videos(
+            query, n, min_dur, target_size=target_size, target_duration=target_duration
+        )
+
+    def download(i: int, video: VideoResult) -> Path | None:
+        cancel_token.raise_if_cancelled()
+        # Videos already downloaded for another project are linked from the store
+        path = MEDIA_STORE.fetch(
+            video.key,
+            target_dir / f"{i:02d}_{video.id}.mp4",
+            lambda path: video.save(path, on_progress=ProgressReporter(video.key), cancel_token=cancel_token),
+        )
+        if path is not None and on_downloaded:
+            on_downloaded(path)
+        return path
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pexels") as executor:
+        candidates = list(executor.map(search, search_terms))
+
+        chosen: List[VideoResult] = []
+        chosen_ids = set()
+        for query, videos in zip(search_terms, candidates):
+            video = next((v for v in videos if v.id not in chosen_ids), None)
+            if video is None:
+                print(colored(f"[-] No videos found for query: '{query}'", "red"))
                 continue
-            width = video_file["width"]
-            height = video_file["height"]
-            resolution = width*height
-            if ".com/video-files" in url:
-                # Only save the URL with the largest resolution
-                if resolution > video_res:
-                    best_url = url
-                    video_res = width*height
-        if len(best_url) > 0:
-            print(colored(f"\t=> \"{query}\" found {len(video_files)} videos.", "cyan"))
-            return VideoResult(id=video["id"], url=best_url, duration=video["duration"], width=width, height=height)
-    print(colored(f"[-] No videos found for query: '{query}'", "red"))
-    return None
-    
-                
+            chosen.append(video)
+            chosen_ids.add(video.id)
+
+        saved = list(executor.map(download, range(len(chosen)), chosen))
 
+    return [path for path in saved if path is not None]
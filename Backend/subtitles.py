@@ -0,0 +1,198 @@
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from moviepy.video.VideoClip import ImageClip
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_PATH = Path(__file__).resolve().parent.parent / "fonts" / "bold_font.ttf"
+
+# The style of the subtitles burned into the video
+FONT_SIZE = 100
+STROKE_COLOR = "black"
+STROKE_WIDTH = 5
+
+# The sizes above are for a video this many pixels high and scaled with the height of others
+REFERENCE_HEIGHT = 1920
+
+# Enough for every line of a few videos at once
+CACHE_SIZE = 2048
+
+
+@lru_cache(maxsize=32)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_path, font_size)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def render_text(
+    text: str,
+    color: str,
+    font_path: str = str(FONT_PATH),
+    font_size: int = FONT_SIZE,
+    stroke_color: str = STROKE_COLOR,
+    stroke_width: int = STROKE_WIDTH,
+) -> np.ndarray:
+    """
+    Draws stroked, centered text with FreeType into a tightly cropped RGBA image.
+
+    Results are cached by all of their arguments, so a line that appears more than once, in
+    this video or a previous one, is only drawn once. The returned array is shared between
+    callers and must not be modified.
+
+    Args:
+        text (str): The text, lines are separated by newlines.
+        color (str): The fill color, a color name or hex code.
+        font_path (str): The TrueType font to draw with.
+        font_size (int): The font size in pixels.
+        stroke_color (str): The color of the outline.
+        stroke_width (int): The width of the outline in pixels.
+
+    Returns:
+        np.ndarray: The text as an RGBA image of shape (height, width, 4).
+    """
+    font = load_font(font_path, font_size)
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox(
+        (0, 0), text, font=font, stroke_width=stroke_width, align="center"
+    )
+
+    image = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    ImageDraw.Draw(image).multiline_text(
+        (-left, -top),
+        text,
+        font=font,
+        fill=color,
+        stroke_width=stroke_width,
+        stroke_fill=stroke_color,
+        align="center",
+    )
+    rgba = np.asarray(image)
+    rgba.setflags(write=False)
+    return rgba
+
+
+def prerender(texts: Iterable[str], color: str, max_workers: int = 4, **style) -> None:
+    """
+    Draws every distinct text up front on a thread pool, filling the render_text cache.
+    Additional keyword arguments are passed on to render_text.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="subtitles") as executor:
+        list(executor.map(lambda text: render_text(text, color, **style), set(texts)))
+
+
+def text_clip(text: str, color: str) -> ImageClip:
+    """
+    Creates a clip of the rendered text with its alpha channel as mask, a drop-in
+    replacement for moviepy's ImageMagick based TextClip.
+    """
+    return ImageClip(render_text(text, color), transparent=True)
+
+
+def anchor(position: str, size: int, frame_size: int) -> int:
+    """
+    Resolves a moviepy style position ("left", "center", "right", "top", "bottom") to the
+    offset of an item of the given size inside the frame.
+    """
+    if position in ("left", "top"):
+        return 0
+    if position in ("right", "bottom"):
+        return frame_size - size
+    return (frame_size - size) // 2
+
+
+class SubtitleCompositor:
+    """
+    Burns subtitles into frames by alpha blending only the bounding box of the active line.
+
+    Every line is rendered and converted to premultiplied float images once, and blending
+    reuses preallocated buffers, so a frame with a caption costs a copy of the frame and a
+    blend of a small band of pixels, and a frame without one is passed through untouched.
+    Frames of the source are never modified, since clips like ImageClip return the same
+    array for every frame. A returned frame with a caption is only valid until the next
+    call, which is how moviepy consumes frames when writing. Use it with `clip.fl`.
+    The text is scaled with the height of the video, relative to REFERENCE_HEIGHT.
+
+    Args:
+        subtitles (list[tuple[tuple[float, float], str]]): The (start, end) times and texts, as
+            returned by moviepy's file_to_subtitles.
+        color (str): The color of the text.
+        frame_size (tuple[int, int]): The (width, height) of the video.
+        subtitles_position (str): The position of the subtitles, e.g. "center,bottom".
+    """
+
+    def __init__(
+        self,
+        subtitles: list[tuple[tuple[float, float], str]],
+        color: str,
+        frame_size: tuple[int, int],
+        subtitles_position: str,
+    ):
+        frame_w, frame_h = frame_size
+        scale = frame_h / REFERENCE_HEIGHT
+        style = {
+            "font_size": round(FONT_SIZE * scale),
+            "stroke_width": max(1, round(STROKE_WIDTH * scale)),
+        }
+        prerender([text for _, text in subtitles], color, **style)
+        horizontal, vertical = (p.strip() for p in subtitles_position.split(","))
+
+        self._starts = []
+        self._cues = []
+        max_h, max_w = 1, 1
+        for (start, end), text in sorted(subtitles):
+            rgba = render_text(text, color, **style)
+            h, w = rgba.shape[:2]
+            x = anchor(horizontal, w, frame_w)
+            y = anchor(vertical, h, frame_h)
+
+            # Clip the text to the frame, lines wider than the video lose their edges
+            left, top = max(0, -x), max(0, -y)
+            rgba = rgba[top:top + frame_h - max(0, y), left:left + frame_w - max(0, x)]
+            h, w = rgba.shape[:2]
+
+            alpha = rgba[:, :, 3:4].astype(np.float32) / 255
+            self._starts.append(start)
+            self._cues.append((
+                end,
+                (max(0, y), max(0, x)),
+                rgba[:, :, :3] * alpha,
+                1 - alpha,
+            ))
+            max_h, max_w = max(max_h, h), max(max_w, w)
+
+        self._buffer = np.empty((max_h, max_w, 3), dtype=np.float32)
+        # The frame captions are blended into, reused for every frame that has one
+        self._frame: np.ndarray | None = None
+
+    def active(self, t: float):
+        """
+        Finds the line shown at time t, if any.
+        """
+        i = bisect_right(self._starts, t) - 1
+        if i < 0 or t >= self._cues[i][0]:
+            return None
+        return self._cues[i]
+
+    def __call__(self, get_frame, t: float) -> np.ndarray:
+        frame = get_frame(t)
+        cue = self.active(t)
+        if cue is None:
+            return frame
+
+        _, (y, x), premultiplied, inverse_alpha = cue
+        h, w = inverse_alpha.shape[:2]
+        if self._frame is None or self._frame.shape != frame.shape or self._frame.dtype != frame.dtype:
+            self._frame = np.empty_like(frame)
+        np.copyto(self._frame, frame)
+        frame = self._frame
+
+        region = frame[y:y + h, x:x + w]
+        buffer = self._buffer[:h, :w]
+        np.multiply(region, inverse_alpha, out=buffer)
+        np.add(buffer, premultiplied, out=buffer)
+        np.copyto(region, buffer, casting="unsafe")
+        return frame
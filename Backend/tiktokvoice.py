@@ -7,12 +7,24 @@
 # --- MODIFIED VERSION --- #
 
 import base64
+import hashlib
+import random
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from threading import Lock
 import requests
-import threading
+from requests.adapters import HTTPAdapter
 
-from typing import List
+from typing import Callable, Iterable, Iterator, List
 from termcolor import colored
+from decouple import config
+
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken
+from backend.EndpointPool import Endpoint, EndpointPool
+from backend.MediaStore import MediaStore
 
 
 VOICES = [
@@ -70,10 +82,29 @@ ENDPOINTS = [
     "https://tiktok-tts.weilnet.workers.dev/api/generation",
     "https://tiktoktts.com/api/tiktok-tts",
 ]
-current_endpoint = 0
+# Every endpoint is a proxy to the same TikTok voices, so they share cached audio
+ENDPOINT_FAMILY = "tiktok"
 # in one conversion, the text can have a maximum length of 300 characters
 TEXT_BYTE_LIMIT = 300
 
+# Maximum number of concurrent requests to the TTS service, also the size of the connection pool
+MAX_WORKERS = config("TTS_MAX_WORKERS", default=4, cast=int)
+
+# Shared session so every request reuses keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS))
+
+# Disk quota of the synthesized audio shared by all projects, 0 means unlimited
+TTS_STORE_MAX_BYTES = config("TTS_STORE_MAX_BYTES", default=1024**3, cast=int)
+
+TTS_STORE = MediaStore(Path("./cache/tts"), max_bytes=TTS_STORE_MAX_BYTES)
+
+# Shared by all projects, so what one project learns about an endpoint spares the others
+ENDPOINT_POOL = EndpointPool(ENDPOINTS)
+
+# Attempts per request, each on the healthiest endpoint at the time
+MAX_ATTEMPTS = 4
+
 
 # create a list by splitting a string, every element has n chars
 def split_string(string: str, chunk_size: int) -> List[str]:
@@ -94,112 +125,251 @@ def split_string(string: str, chunk_size: int) -> List[str]:
     return result
 
 
-# checking if the website that provides the service is available
-def get_api_response() -> requests.Response:
-    url = f"{ENDPOINTS[current_endpoint].split('/a')[0]}"
-    response = requests.get(url)
-    return response
+# grouping consecutive sentences into as few requests as the length limit allows
+def iter_packs(sentences: Iterable[str], limit: int = TEXT_BYTE_LIMIT - 1) -> Iterator[List[str]]:
+    # A pack is complete as soon as the next sentence does not fit, so sentences that are still
+    # being generated can be packed as they arrive
+    pack = []
+    length = 0
+    for sentence in sentences:
+        # Sentences are joined with ". ", which is what they were split on
+        if pack and length + 2 + len(sentence) + 1 <= limit:
+            pack.append(sentence)
+            length += 2 + len(sentence)
+        else:
+            if pack:
+                yield pack
+            pack = [sentence]
+            length = len(sentence)
+    if pack:
+        yield pack
+
 
+def pack_sentences(sentences: List[str], limit: int = TEXT_BYTE_LIMIT - 1) -> List[List[str]]:
+    return list(iter_packs(sentences, limit))
 
-# saving the audio file
-def save_audio_file(base64_data: str, target_dir: Path, i: int) -> Path:
-    audio_bytes = base64.b64decode(base64_data)
-    filename = f"{i}.mp3"
-    target_dir.mkdir(parents=True, exist_ok=True)
-    with open(target_dir / filename, "wb") as file:
-        file.write(audio_bytes)
-    return target_dir / filename
+
+# the text a pack of sentences is synthesized from, ending in a full stop so it is spoken as one
+def pack_text(pack: List[str]) -> str:
+    text = ". ".join(pack)
+    return text if text.endswith((".", "!", "?")) else f"{text}."
+
+
+# checking if the website that provides the service is available
+def get_api_response(url: str, session: requests.Session = SESSION) -> requests.Response:
+    response = session.get(url.split("/a")[0], timeout=10)
+    return response
 
 
 # send POST request to get the audio data
-def generate_audio(text: str, voice: str) -> bytes:
-    url = f"{ENDPOINTS[current_endpoint]}"
+def generate_audio(text: str, voice: str, url: str, session: requests.Session = SESSION) -> requests.Response:
     headers = {"Content-Type": "application/json"}
     data = {"text": text, "voice": voice}
-    response = requests.post(url, headers=headers, json=data)
-    return response.content
 
+    response = session.post(url, headers=headers, json=data, timeout=(10, 60))
+    return response
 
-# creates an text to speech audio file
-def tts(text: str, voice: str, audio_parts: Path, i: int) -> Path:
-    if get_api_response().status_code == 200:
-        print(colored("[+] TikTok TTS Service available!", "green"))
-    else:
-        if get_api_response().status_code == 200:
-            print(colored("[+] TTS Service available!", "green"))
-        else:
-            print(
-                colored(
-                    "[-] TTS Service not available and probably temporarily rate limited, try again later...",
-                    "red",
-                )
-            )
-            return None
 
-    # checking if arguments are valid
-    if voice == "none":
-        print(colored("[-] Please specify a voice", "red"))
-        return
+# extracting the base64 encoded audio from a response, which is either plain base64 or a data URL
+def extract_audio(response: requests.Response) -> str:
+    response.raise_for_status()
+    try:
+        audio = response.json().get("data")
+    except (ValueError, AttributeError):
+        raise Exception(f"Unexpected TTS response: {response.text[:200]}")
+    if not isinstance(audio, str) or audio in ("", "error"):
+        raise Exception(f"No audio in TTS response: {response.text[:200]}")
+    if audio.startswith("data:"):
+        audio = audio.split(",", 1)[1]
+    return audio
 
-    if voice not in VOICES:
-        print(colored("[-] Voice not available", "red"))
-        return
 
-    if not text:
-        print(colored("[-] Please specify a text", "red"))
-        return
+# whitespace and unicode forms do not change how a text is spoken
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
 
-    # creating the audio file
-    try:
-        if len(text) < TEXT_BYTE_LIMIT:
-            audio = generate_audio((text), voice)
-            if current_endpoint == 0:
-                audio_base64_data = str(audio).split('"')[5]
-            else:
-                audio_base64_data = str(audio).split('"')[3].split(",")[1]
 
-            if audio_base64_data == "error":
-                print(colored("[-] This voice is unavailable right now", "red"))
-                return
+# identifying the audio of a text spoken in a voice, across projects
+def audio_key(text: str, voice: str) -> str:
+    h = hashlib.sha256(f"{ENDPOINT_FAMILY}\0{voice}\0{normalize_text(text)}".encode()).hexdigest()
+    return f"{ENDPOINT_FAMILY}_{voice}_{h[:32]}"
+
 
+class TTSClient:
+    """
+    Synthesizes the sentences of a script with the TikTok TTS service.
+
+    The service is checked for availability once per client instead of once per sentence,
+    and the sentences are synthesized concurrently over the shared session, so a script
+    takes about as long as its slowest request. The latency of every request is recorded.
+
+    Requests are routed through the shared endpoint pool. A failed request is retried with
+    exponential backoff on whichever endpoint is healthiest at that time, so a slow or rate
+    limited endpoint is avoided instead of failing the project.
+
+    Sentences are looked up in a store shared by all projects before anything is sent, by
+    voice and normalized text, so a sentence that was spoken before is never synthesized
+    again, and the service is not even checked when every sentence is stored.
+
+    Args:
+        voice (str): The voice to speak with.
+        max_workers (int): The number of requests that may run at the same time.
+        cancel_token (CancellationToken): Optional. Stops starting requests when cancelled.
+        session (requests.Session): The session to send requests with.
+        pool (EndpointPool): The endpoints to route requests to.
+    """
+
+    def __init__(
+        self,
+        voice: str,
+        max_workers: int = MAX_WORKERS,
+        cancel_token: CancellationToken | None = None,
+        session: requests.Session = SESSION,
+        pool: EndpointPool = ENDPOINT_POOL,
+    ):
+        if voice not in VOICES:
+            raise ValueError(f"Voice '{voice}' is not available.")
+        self.voice = voice
+        self.max_workers = max_workers
+        self.cancel_token = cancel_token or CancellationToken()
+        self.session = session
+        self.pool = pool
+        self.latencies: list[float] = []
+        self._available: bool | None = None
+        self._available_lock = Lock()
+        # Shared by prefetching and synthesizing, so no more than `max_workers` requests run at once
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+
+    def close(self) -> None:
+        """
+        Stop the requests that have not started yet, running ones finish in the background.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _probe(self, endpoint: Endpoint) -> None:
+        try:
+            ok = get_api_response(endpoint.url, self.session).status_code == 200
+        except requests.RequestException:
+            ok = False
+        if not ok:
+            self.pool.open(endpoint)
+
+    def check_available(self) -> None:
+        """
+        Raises if no endpoint of the service is reachable, only the first call sends requests.
+        Unreachable endpoints are taken out of the pool until their circuit closes again.
+        """
+        with self._available_lock:
+            if self._available is None:
+                for endpoint in self.pool.endpoints:
+                    self._probe(endpoint)
+                self._available = self.pool.available
+                if self._available:
+                    print(colored("[+] TikTok TTS Service available!", "green"))
+        if not self._available:
+            raise Exception("TTS Service not available and probably temporarily rate limited, try again later.")
+
+    def _request(self, text: str) -> str:
+        error = None
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0:
+                # Exponential backoff with jitter, so retries of concurrent requests spread out
+                if self.cancel_token.wait(0.5 * 2 ** (attempt - 1) * (1 + random.random())):
+                    break
+            self.cancel_token.raise_if_cancelled()
+
+            endpoint = self.pool.choose()
+            started = time.perf_counter()
+            try:
+                audio = extract_audio(generate_audio(text, self.voice, endpoint.url, self.session))
+            except Exception as e:
+                self.pool.record(endpoint, time.perf_counter() - started, ok=False)
+                LOGGER.debug(f"TTS request to '{endpoint.url}' failed: {e}")
+                error = e
+                continue
+            latency = time.perf_counter() - started
+            self.pool.record(endpoint, latency, ok=True)
+            self.latencies.append(latency)
+            return audio
+
+        self.cancel_token.raise_if_cancelled()
+        raise Exception(f"TTS failed after {MAX_ATTEMPTS} attempts, the voice '{self.voice}' may be unavailable: {error}")
+
+    def synthesize(self, text: str) -> bytes:
+        """
+        Synthesize a text, splitting texts that are too long for a single request.
+        """
+        text = normalize_text(text)
+        if not text:
+            raise ValueError("Cannot synthesize an empty text.")
+        self.check_available()
+        text_parts = [text] if len(text) < TEXT_BYTE_LIMIT else split_string(text, TEXT_BYTE_LIMIT - 1)
+        return b"".join(base64.b64decode(self._request(text_part)) for text_part in text_parts)
+
+    def _download(self, text: str) -> Callable[[Path], Path]:
+        def download(path: Path) -> Path:
+            path.write_bytes(self.synthesize(text))
+            return path
+        return download
+
+    def _store(self, text: str) -> Path:
+        # Synthesized into the store only, by voice and normalized text
+        return TTS_STORE.ensure(audio_key(text, self.voice), self._download(text), suffix=".mp3")
+
+    def _synthesize_part(self, text: str, target_dir: Path, i: int) -> Path:
+        # Always fetched from the store, which holds the part if an earlier run synthesized it,
+        # so a part left over from a run with different texts is never reused
+        target_dir.mkdir(parents=True, exist_ok=True)
+        return TTS_STORE.fetch(audio_key(text, self.voice), target_dir / f"{i}.mp3", self._download(text), suffix=".mp3")
+
+    def prefetch(self, texts: Iterable[str]) -> List[Future]:
+        """
+        Start synthesizing every text into the store as soon as the iterable produces it, so the
+        texts can be synthesized while they are still being generated. Nothing is written
+        outside the store; `synthesize_all` of the same texts afterwards takes them from it.
+
+        Returns:
+            List[Future]: The requests, in the order of the texts. Wait for them before
+                `synthesize_all`, which then only sends the ones that failed again.
+        """
+        futures = []
+        try:
+            for text in texts:
+                futures.append(self._executor.submit(self._store, text))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return futures
+
+    def synthesize_all(self, sentences: List[str], target_dir: Path) -> List[Path]:
+        """
+        Synthesize every sentence into `<target_dir>/<i>.mp3`, all at once.
+
+        Parts that were synthesized before are taken from the store, so an interrupted script
+        resumes where it stopped.
+
+        Returns:
+            List[Path]: The parts in the order of the sentences.
+        """
+        started = time.perf_counter()
+        futures = [
+            self._executor.submit(self._synthesize_part, sentence, target_dir, i)
+            for i, sentence in enumerate(sentences)
+        ]
+        try:
+            paths = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        if self.latencies:
+            LOGGER.info(
+                f"Synthesized {len(sentences)} sentences in {time.perf_counter() - started:.2f}s with "
+                f"{len(self.latencies)} requests, slowest {max(self.latencies):.2f}s, "
+                f"mean {sum(self.latencies) / len(self.latencies):.2f}s."
+            )
         else:
-            # Split longer text into smaller parts
-            text_parts = split_string(text, 299)
-            audio_base64_data = [None] * len(text_parts)
-
-            # Define a thread function to generate audio for each text part
-            def generate_audio_thread(text_part, index):
-                audio = generate_audio(text_part, voice)
-                if current_endpoint == 0:
-                    base64_data = str(audio).split('"')[5]
-                else:
-                    base64_data = str(audio).split('"')[3].split(",")[1]
-
-                if audio_base64_data == "error":
-                    print(colored("[-] This voice is unavailable right now", "red"))
-                    return "error"
-
-                audio_base64_data[index] = base64_data
-
-            threads = []
-            for index, text_part in enumerate(text_parts):
-                # Create and start a new thread for each text part
-                thread = threading.Thread(
-                    target=generate_audio_thread, args=(text_part, index)
-                )
-                thread.start()
-                threads.append(thread)
-
-            # Wait for all threads to complete
-            for thread in threads:
-                thread.join()
-
-            # Concatenate the base64 data in the correct order
-            audio_base64_data = "".join(audio_base64_data)
-
-        n = save_audio_file(audio_base64_data, audio_parts, i)
-        print(colored(f"[+] Audio file saved successfully as '{n}'", "green"))
-        return n
-
-    except Exception as e:
-        print(colored(f"[-] An error occurred during TTS: {e}", "red"))
+            LOGGER.info(f"All {len(sentences)} sentences were synthesized before, no requests sent.")
+        return paths
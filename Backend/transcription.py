@@ -0,0 +1,102 @@
+import hashlib
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import assemblyai as aai
+from decouple import config
+
+from backend import LOGGER
+from backend.CancellationToken import CancellationToken
+from backend.RequestCache import REQUEST_CACHE
+
+ASSEMBLY_AI_API_KEY = config("ASSEMBLY_AI_API_KEY", default="")
+
+# Another AssemblyAI compatible server, like the mock in mocks/assemblyai_server.py
+ASSEMBLY_AI_BASE_URL = config("ASSEMBLY_AI_BASE_URL", default="")
+
+# Seconds between two checks of a transcript that is still being processed
+POLLING_INTERVAL = 1.0
+
+# Uploading the audio and creating the transcript block, so they run in the background
+EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="transcription")
+
+LANGUAGE_MAPPING = {
+    "br": "pt",
+    "id": "en",  # AssemblyAI doesn't have Indonesian
+    "jp": "ja",
+    "kr": "ko",
+}
+
+
+def enabled() -> bool:
+    return ASSEMBLY_AI_API_KEY is not None and ASSEMBLY_AI_API_KEY != ""
+
+
+def transcript_key(audio_path: Path, lang_code: str) -> str:
+    """
+    Identifies the transcript of an audio file by its content, not by where it is stored.
+    """
+    h = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return json.dumps({"audio": h.hexdigest(), "language": lang_code})
+
+
+class PendingTranscript:
+    """
+    The SRT subtitles of an audio file that is being transcribed by AssemblyAI.
+
+    Submitting uploads the audio and creates the transcript in the background, and the result
+    is only waited for when it is needed, so the transcription runs while other stages do.
+    Finished transcripts are cached by the content of the audio, so the same narration is
+    never transcribed twice.
+
+    Args:
+        audio_path (Path): The audio to transcribe.
+        voice (str): The language prefix of the voice, e.g. "en".
+    """
+
+    def __init__(self, audio_path: Path, voice: str):
+        self.lang_code = LANGUAGE_MAPPING.get(voice, voice)
+        self.key = transcript_key(audio_path, self.lang_code)
+        self.cached: str | None = REQUEST_CACHE.get(self.key, namespace="transcripts")
+        self._submitted: Future | None = None
+        if self.cached is None:
+            self._submitted = EXECUTOR.submit(self._submit, audio_path)
+            LOGGER.info(f"Submitted '{audio_path}' for transcription.")
+
+    def _submit(self, audio_path: Path) -> aai.Transcript:
+        aai.settings.api_key = ASSEMBLY_AI_API_KEY
+        if ASSEMBLY_AI_BASE_URL:
+            aai.settings.base_url = ASSEMBLY_AI_BASE_URL
+        transcriber = aai.Transcriber(config=aai.TranscriptionConfig(language_code=self.lang_code))
+        return transcriber.submit(str(audio_path))
+
+    def result(self, cancel_token: CancellationToken | None = None) -> str:
+        """
+        Wait for the transcript and return it as SRT subtitles.
+        """
+        if self.cached is not None:
+            return self.cached
+
+        cancel_token = cancel_token or CancellationToken()
+        # The upload takes a while for long narrations, it is not waited for once cancelled
+        while not self._submitted.done():
+            if cancel_token.wait(POLLING_INTERVAL):
+                self._submitted.cancel()
+                cancel_token.raise_if_cancelled()
+        transcript = self._submitted.result()
+        while transcript.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error):
+            if cancel_token.wait(POLLING_INTERVAL):
+                cancel_token.raise_if_cancelled()
+            transcript = aai.Transcript.get_by_id(transcript.id)
+
+        if transcript.status == aai.TranscriptStatus.error:
+            raise Exception(f"Transcription failed: {transcript.error}")
+
+        subtitles = transcript.export_subtitles_srt()
+        REQUEST_CACHE.set(self.key, subtitles, namespace="transcripts")
+        self.cached = subtitles
+        return subtitles
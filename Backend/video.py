@@ -1,30 +1,85 @@
 import os
+from dataclasses import dataclass
 from pathlib import Path
 import uuid
 
 import requests
+import srt
 import srt_equalizer
-import assemblyai as aai
 
 from typing import List
 
+from proglog import TqdmProgressBarLogger
 from termcolor import colored
 
-from datetime import timedelta
-
-from moviepy.video.VideoClip import TextClip
 
 from moviepy.editor import VideoFileClip, concatenate_videoclips
-from moviepy.video.tools.subtitles import SubtitlesClip
-from moviepy.video.compositing import CompositeVideoClip
+from moviepy.video.tools.subtitles import file_to_subtitles
 
 from moviepy.audio.io.AudioFileClip import AudioFileClip
+from moviepy.audio.AudioClip import CompositeAudioClip
+from moviepy.audio.fx.audio_loop import audio_loop
 from moviepy.video.fx import crop
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+
+from backend import alignment, transcription
+from backend.audio import AudioManifest
+from backend.CancellationToken import CancellationToken
+from backend.EncoderProfile import ENCODER_PROFILES, EncoderProfile
+from backend.subtitles import SubtitleCompositor
+
+
+class CancellableBarLogger(TqdmProgressBarLogger):
+    """
+    A moviepy progress logger that aborts the encode as soon as the token is cancelled.
+
+    moviepy reports progress once per written frame and audio chunk, so raising from the
+    callback stops the render within a frame and lets the ffmpeg writer shut down.
+    """
+
+    def __init__(self, cancel_token: CancellationToken):
+        super().__init__(print_messages=False)
+        self.cancel_token = cancel_token
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        self.cancel_token.raise_if_cancelled()
+        super().bars_callback(bar, attr, value, old_value)
 
 
-from decouple import config
+def write_videofile(clip, target: Path, threads: int, cancel_token: CancellationToken | None = None, **kwargs) -> Path:
+    """
+    Writes a clip to a temporary file next to the target and moves it into place once complete.
+
+    Partial outputs are removed when the render fails or is cancelled, so an existing
+    target is always a finished video.
 
-ASSEMBLY_AI_API_KEY = config("ASSEMBLY_AI_API_KEY")
+    Args:
+        clip (VideoClip): The clip to render.
+        target (Path): The path of the finished video.
+        threads (int): The number of threads ffmpeg may use.
+        cancel_token (CancellationToken): Optional. Aborts the encode when cancelled.
+
+    Returns:
+        Path: The path to the finished video.
+    """
+    target = Path(target)
+    partial = target.with_name(f"{target.stem}.part{target.suffix}")
+    temp_audio = target.with_name(f"{target.stem}.part.mp3")
+    logger = CancellableBarLogger(cancel_token) if cancel_token else "bar"
+    try:
+        clip.write_videofile(
+            str(partial),
+            threads=threads,
+            temp_audiofile=str(temp_audio),
+            logger=logger,
+            **kwargs,
+        )
+        os.replace(partial, target)
+    finally:
+        for path in (partial, temp_audio):
+            path.unlink(missing_ok=True)
+    return target
 
 
 def save_video(video_url: str, target: Path) -> Path:
@@ -45,115 +100,136 @@ def save_video(video_url: str, target: Path) -> Path:
     return target
 
 
-def __generate_subtitles_assemblyai(audio_path: str, voice: str) -> str:
+def generate_subtitles(
+    audio_path: Path,
+    manifest: AudioManifest,
+    voice: str,
+    target: Path,
+    transcript: transcription.PendingTranscript | None = None,
+    cancel_token: CancellationToken | None = None,
+) -> str:
     """
     Generates subtitles from a given audio file and returns the path to the subtitles.
 
     Args:
         audio_path (str): The path to the audio file to generate subtitles from.
+        manifest (AudioManifest): The parts of the audio, with the sentences they speak.
+        transcript (PendingTranscript): Optional. The transcription of the audio, if it was
+            submitted already. Only used with AssemblyAI.
+        cancel_token (CancellationToken): Optional. Stops waiting for the transcription when cancelled.
 
     Returns:
-        str: The generated subtitles
+        str: The path to the generated subtitles.
     """
 
-    language_mapping = {
-        "br": "pt",
-        "id": "en",  # AssemblyAI doesn't have Indonesian
-        "jp": "ja",
-        "kr": "ko",
-    }
+    def equalize_subtitles(srt_path: str, max_chars: int = alignment.MAX_CAPTION_CHARS) -> None:
+        # Equalize subtitles
+        srt_equalizer.equalize_srt_file(srt_path, srt_path, max_chars)
+
+    if transcription.enabled():
+        print(colored("[+] Creating subtitles using AssemblyAI", "blue"))
+        transcript = transcript or transcription.PendingTranscript(audio_path, voice)
+        with open(target, "w") as file:
+            file.write(transcript.result(cancel_token))
 
-    if voice in language_mapping:
-        lang_code = language_mapping[voice]
+        # Equalize subtitles
+        equalize_subtitles(str(target))
     else:
-        lang_code = voice
+        # The captions are aligned to the speech and short enough already
+        print(colored("[+] Creating subtitles locally", "blue"))
+        with open(target, "w") as file:
+            file.write(srt.compose(alignment.align(manifest)))
 
-    aai.settings.api_key = ASSEMBLY_AI_API_KEY
-    config = aai.TranscriptionConfig(language_code=lang_code)
-    transcriber = aai.Transcriber(config=config)
-    transcript = transcriber.transcribe(audio_path)
-    subtitles = transcript.export_subtitles_srt()
+    print(colored("[+] Subtitles generated.", "green"))
 
-    return subtitles
+    return target
 
 
-def __generate_subtitles_locally(
-    sentences: List[str], audio_clips: List[AudioFileClip]
-) -> str:
+@dataclass
+class TimelineEntry:
     """
-    Generates subtitles from a given audio file and returns the path to the subtitles.
-
-    Args:
-        sentences (List[str]): all the sentences said out loud in the audio clips
-        audio_clips (List[AudioFileClip]): all the individual audio clips which will make up the final audio track
-    Returns:
-        str: The generated subtitles
+    A clip on the timeline of the combined video: the first `duration` seconds of `path`.
     """
+    path: Path
+    duration: float
 
-    def convert_to_srt_time_format(total_seconds):
-        # Convert total seconds to the SRT time format: HH:MM:SS,mmm
-        if total_seconds == 0:
-            return "0:00:00,0"
-        return str(timedelta(seconds=total_seconds)).rstrip("0").replace(".", ",")
-
-    start_time = 0
-    subtitles = []
-
-    for i, (sentence, audio_clip) in enumerate(zip(sentences, audio_clips), start=1):
-        duration = audio_clip.duration
-        end_time = start_time + duration
-
-        # Format: subtitle index, start time --> end time, sentence
-        subtitle_entry = f"{i}\n{convert_to_srt_time_format(start_time)} --> {convert_to_srt_time_format(end_time)}\n{sentence}\n"
-        subtitles.append(subtitle_entry)
 
-        start_time += duration  # Update start time for the next subtitle
-
-    return "\n".join(subtitles)
+def probe_duration(path: Path) -> float:
+    """
+    Reads the duration of a media file from its header without decoding it.
+    """
+    return ffmpeg_parse_infos(str(path))["duration"]
 
 
-def generate_subtitles(
-    audio_path: Path,
-    sentences: List[str],
-    audio_clips: List[AudioFileClip],
-    voice: str,
-    target: Path,
-) -> str:
+def plan_timeline(
+    video_durations: List[tuple[Path, float]],
+    max_duration: float,
+    max_clip_duration: float,
+) -> List[TimelineEntry]:
     """
-    Generates subtitles from a given audio file and returns the path to the subtitles.
+    Plans which part of which video is shown when, the same way combine_videos cuts them:
+    the videos are repeated in order, each shortened to an equal share of the total duration,
+    until the timeline is as long as the audio.
 
     Args:
-        audio_path (str): The path to the audio file to generate subtitles from.
-        sentences (List[str]): all the sentences said out loud in the audio clips
-        audio_clips (List[AudioFileClip]): all the individual audio clips which will make up the final audio track
+        video_durations (List[tuple[Path, float]]): The videos and their durations.
+        max_duration (float): The duration of the combined video.
+        max_clip_duration (float): The maximum duration of each clip.
 
     Returns:
-        str: The path to the generated subtitles.
+        List[TimelineEntry]: The clips in the order they are shown.
     """
+    # Required duration of each clip
+    req_dur = max_duration / len(video_durations)
 
-    def equalize_subtitles(srt_path: str, max_chars: int = 10) -> None:
-        # Equalize subtitles
-        srt_equalizer.equalize_srt_file(srt_path, srt_path, max_chars)
-
-    if ASSEMBLY_AI_API_KEY is not None and ASSEMBLY_AI_API_KEY != "":
-        print(colored("[+] Creating subtitles using AssemblyAI", "blue"))
-        subtitles = __generate_subtitles_assemblyai(audio_path, voice)
-    else:
-        print(colored("[+] Creating subtitles locally", "blue"))
-        subtitles = __generate_subtitles_locally(sentences, audio_clips)
-        # print(colored("[-] Local subtitle generation has been disabled for the time being.", "red"))
-        # print(colored("[-] Exiting.", "red"))
-        # sys.exit(1)
-
-    with open(target, "w") as file:
-        file.write(subtitles)
+    timeline = []
+    tot_dur = 0
+    # Stop within a millisecond of the end, instead of appending slivers caused by float rounding
+    while max_duration - tot_dur > 1e-3:
+        for path, duration in video_durations:
+            if max_duration - tot_dur <= 1e-3:
+                break
+            # Check if clip is longer than the remaining audio
+            if (max_duration - tot_dur) < duration:
+                duration = max_duration - tot_dur
+            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
+            elif req_dur < duration:
+                duration = req_dur
+            duration = min(duration, max_clip_duration)
 
-    # Equalize subtitles
-    equalize_subtitles(str(target))
+            timeline.append(TimelineEntry(path=path, duration=duration))
+            tot_dur += duration
+    return timeline
 
-    print(colored("[+] Subtitles generated.", "green"))
 
-    return target
+def fit_to_frame(clip, size: tuple[int, int]):
+    """
+    Center crops a clip to the aspect ratio of the given size and resizes it to that size.
+    Clips that already have the size, for example normalized ones, are returned as they are.
+    """
+    if tuple(clip.size) == tuple(size):
+        return clip
+
+    ratio = size[0] / size[1]
+    # Not all videos are same size,
+    # so we need to resize them
+    if round((clip.w / clip.h), 4) < ratio:
+        clip = crop.crop(
+            clip,
+            width=clip.w,
+            height=round(clip.w / ratio),
+            x_center=clip.w / 2,
+            y_center=clip.h / 2,
+        )
+    else:
+        clip = crop.crop(
+            clip,
+            width=round(ratio * clip.h),
+            height=clip.h,
+            x_center=clip.w / 2,
+            y_center=clip.h / 2,
+        )
+    return clip.resize(size)
 
 
 def combine_videos(
@@ -162,6 +238,8 @@ def combine_videos(
     max_clip_duration: int,
     threads: int,
     combined_video_path: Path,
+    cancel_token: CancellationToken | None = None,
+    profile: EncoderProfile = ENCODER_PROFILES["final"],
 ) -> str:
     """
     Combines a list of videos into one video and returns the path to the combined video.
@@ -171,61 +249,40 @@ def combine_videos(
         max_duration (int): The maximum duration of the combined video.
         max_clip_duration (int): The maximum duration of each clip.
         threads (int): The number of threads to use for the video processing.
+        cancel_token (CancellationToken): Optional. Aborts the encode when cancelled.
+        profile (EncoderProfile): The size, frame rate and encoder settings of the video.
 
     Returns:
         str: The path to the combined video.
     """
 
-    # Required duration of each clip
-    req_dur = max_duration / len(video_paths)
+    # Plan the whole timeline from the file headers before decoding anything
+    timeline = plan_timeline(
+        [(Path(video_path), probe_duration(video_path)) for video_path in video_paths],
+        max_duration,
+        max_clip_duration,
+    )
 
     print(colored("[+] Combining videos...", "blue"))
-    print(colored(f"[+] Each clip will be maximum {req_dur} seconds long.", "blue"))
-
-    clips = []
-    tot_dur = 0
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    while tot_dur < max_duration:
-        for video_path in video_paths:
-            clip = VideoFileClip(str(video_path))
-            clip = clip.without_audio()
-            # Check if clip is longer than the remaining audio
-            if (max_duration - tot_dur) < clip.duration:
-                clip = clip.subclip(0, (max_duration - tot_dur))
-            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
-            elif req_dur < clip.duration:
-                clip = clip.subclip(0, req_dur)
-            clip = clip.set_fps(30)
-
-            # Not all videos are same size,
-            # so we need to resize them
-            if round((clip.w / clip.h), 4) < 0.5625:
-                clip = crop.crop(
-                    clip,
-                    width=clip.w,
-                    height=round(clip.w / 0.5625),
-                    x_center=clip.w / 2,
-                    y_center=clip.h / 2,
-                )
-            else:
-                clip = crop.crop(
-                    clip,
-                    width=round(0.5625 * clip.h),
-                    height=clip.h,
-                    x_center=clip.w / 2,
-                    y_center=clip.h / 2,
-                )
-            clip = clip.resize((1080, 1920))
-
-            if clip.duration > max_clip_duration:
-                clip = clip.subclip(0, max_clip_duration)
-
+    print(colored(f"[+] Each clip will be maximum {max_duration / len(video_paths)} seconds long.", "blue"))
+
+    # Open every source once, all of its occurrences on the timeline share the same reader
+    readers = {}
+    try:
+        clips = []
+        for entry in timeline:
+            if entry.path not in readers:
+                readers[entry.path] = VideoFileClip(str(entry.path), audio=False)
+            clip = readers[entry.path].subclip(0, entry.duration)
+            clip = fit_to_frame(clip.set_fps(profile.fps), profile.size)
             clips.append(clip)
-            tot_dur += clip.duration
 
-    final_clip = concatenate_videoclips(clips)
-    final_clip = final_clip.set_fps(30)
-    final_clip.write_videofile(str(combined_video_path), threads=threads)
+        final_clip = concatenate_videoclips(clips)
+        final_clip = final_clip.set_fps(profile.fps)
+        write_videofile(final_clip, combined_video_path, threads, cancel_token, **profile.moviepy_params())
+    finally:
+        for reader in readers.values():
+            reader.close()
 
     return str(combined_video_path)
 
@@ -238,6 +295,9 @@ def generate_video(
     subtitles_position: str,
     text_color: str,
     target: Path,
+    cancel_token: CancellationToken | None = None,
+    music_path: Path | None = None,
+    profile: EncoderProfile = ENCODER_PROFILES["final"],
 ) -> Path:
     """
     This function creates the final video, with subtitles and audio.
@@ -248,6 +308,9 @@ def generate_video(
         subtitles_path (str): The path to the subtitles.
         threads (int): The number of threads to use for the video processing.
         subtitles_position (str): The position of the subtitles.
+        cancel_token (CancellationToken): Optional. Aborts the encode when cancelled.
+        music_path (Path): Optional. Background music, mixed in at 10% volume.
+        profile (EncoderProfile): The encoder settings of the video.
 
     Returns:
         str: The path to the final video.
@@ -255,35 +318,28 @@ def generate_video(
     if target.exists():
         return target
 
-    # Make a generator that returns a TextClip when called with consecutive
-    generator = lambda txt: TextClip(
-        txt,
-        font="../fonts/bold_font.ttf",
-        fontsize=100,
-        color=text_color,
-        stroke_color="black",
-        stroke_width=5,
-    )
-
-    # Split the subtitles position into horizontal and vertical
-    horizontal_subtitles_position, vertical_subtitles_position = (
-        subtitles_position.split(",")
-    )
-
-    # Burn the subtitles into the video
-    subtitles = SubtitlesClip(subtitles_path, generator)
-    result = CompositeVideoClip.CompositeVideoClip(
-        [
-            VideoFileClip(combined_video_path),
-            subtitles.set_position(
-                (horizontal_subtitles_position, vertical_subtitles_position)
-            ),
-        ]
+    # Burn the subtitles into the video, blending only the area of the line that is shown
+    video = VideoFileClip(combined_video_path)
+    compositor = SubtitleCompositor(
+        file_to_subtitles(subtitles_path), text_color, tuple(video.size), subtitles_position
     )
+    result = video.fl(compositor)
 
     # Add the audio
     audio = AudioFileClip(tts_path)
-    result = result.set_audio(audio)
+    sources = [video, audio]
+    if music_path:
+        # Loop the song under the narration at 10% volume
+        song = AudioFileClip(str(music_path))
+        sources.append(song)
+        music = audio_loop(song, duration=audio.duration).volumex(0.1)
+        result = result.set_audio(CompositeAudioClip([audio, music]).set_duration(audio.duration))
+    else:
+        result = result.set_audio(audio)
 
-    result.write_videofile(str(target), threads=threads or 2)
+    try:
+        write_videofile(result, target, threads or 2, cancel_token, **profile.moviepy_params())
+    finally:
+        for source in sources:
+            source.close()
     return target
@@ -9,6 +9,9 @@ const customPrompt = document.querySelector("#customPrompt");
 const generateButton = document.querySelector("#generateButton");
 const cancelButton = document.querySelector("#cancelButton");
 
+// The job of the video being generated, the cancel button only cancels this one
+let currentJobId = null;
+
 const advancedOptionsToggle = document.querySelector("#advancedOptionsToggle");
 
 advancedOptionsToggle.addEventListener("click", () => {
@@ -24,9 +27,13 @@ advancedOptionsToggle.addEventListener("click", () => {
 
 const cancelGeneration = () => {
   console.log("Canceling generation...");
+  if (currentJobId === null) {
+    return;
+  }
   // Send request to /cancel
   fetch("http://localhost:8080/api/cancel", {
     method: "POST",
+    body: JSON.stringify({ jobId: currentJobId }),
     headers: {
       "Content-Type": "application/json",
       Accept: "application/json",
@@ -102,18 +109,54 @@ const generateVideo = () => {
     .then((response) => response.json())
     .then((data) => {
       console.log(data);
-      alert(data.message);
+      if (data.status !== "success") {
+        throw new Error(data.message);
+      }
+      currentJobId = data.data.jobId;
+      return pollJob(currentJobId);
+    })
+    .then((job) => {
+      console.log(job);
+      currentJobId = null;
+      if (job.state === "succeeded") {
+        alert(`Video generated! See ${job.artifacts.final} for result.`);
+      } else {
+        alert(`Video generation ${job.state}: ${job.error}`);
+      }
       // Hide cancel button after generation is complete
       generateButton.disabled = false;
       generateButton.classList.remove("hidden");
       cancelButton.classList.add("hidden");
     })
     .catch((error) => {
+      currentJobId = null;
       alert("An error occurred. Please try again later.");
       console.log(error);
     });
 };
 
+// Poll the status of a queued job until it is finished
+const pollJob = (jobId, interval = 2000) =>
+  new Promise((resolve, reject) => {
+    const poll = () => {
+      fetch(`http://localhost:8080/api/jobs/${jobId}`, {
+        headers: { Accept: "application/json" },
+      })
+        .then((response) => response.json())
+        .then((data) => {
+          const job = data.data;
+          if (job.state === "queued" || job.state === "running") {
+            console.log(`Job ${jobId} is ${job.state} (${job.stage})`);
+            setTimeout(poll, interval);
+          } else {
+            resolve(job);
+          }
+        })
+        .catch(reject);
+    };
+    poll();
+  });
+
 generateButton.addEventListener("click", generateVideo);
 cancelButton.addEventListener("click", cancelGeneration);
 
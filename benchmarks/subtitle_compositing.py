@@ -0,0 +1,72 @@
+"""
+Compares the per-frame cost of burning in subtitles with moviepy's CompositeVideoClip and
+with the bounding-box SubtitleCompositor.
+
+Run from the repository root:
+
+    python -m benchmarks.subtitle_compositing
+"""
+import argparse
+import time
+
+import numpy as np
+from moviepy.editor import ColorClip
+from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
+from moviepy.video.tools.subtitles import SubtitlesClip
+
+from backend.subtitles import SubtitleCompositor, text_clip
+
+SIZE = (1080, 1920)
+FPS = 30
+
+
+def make_subtitles(duration: float, cue_duration: float, gap: float) -> list[tuple[tuple[float, float], str]]:
+    words = ["Money", "printer", "goes", "brrr", "every", "single", "day"]
+    subtitles = []
+    t, i = 0.0, 0
+    while t + cue_duration <= duration:
+        subtitles.append(((t, t + cue_duration), f"{words[i % len(words)]} {words[(i + 1) % len(words)]}"))
+        t += cue_duration + gap
+        i += 1
+    return subtitles
+
+
+def time_frames(clip, duration: float) -> float:
+    times = np.arange(0, duration, 1 / FPS)
+    started = time.perf_counter()
+    for t in times:
+        clip.get_frame(t)
+    return (time.perf_counter() - started) / len(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of video to composite.")
+    parser.add_argument("--position", default="center,bottom", help="The subtitles position.")
+    parser.add_argument("--color", default="Yellow", help="The subtitles color.")
+    args = parser.parse_args()
+
+    subtitles = make_subtitles(args.duration, cue_duration=0.8, gap=0.2)
+    background = ColorClip(SIZE, color=(40, 80, 120), duration=args.duration).set_fps(FPS)
+
+    horizontal, vertical = args.position.split(",")
+    composite = CompositeVideoClip([
+        background,
+        SubtitlesClip(subtitles, lambda txt: text_clip(txt, args.color)).set_position((horizontal, vertical)),
+    ])
+    bbox = background.fl(SubtitleCompositor(subtitles, args.color, SIZE, args.position))
+
+    # Both paths share the rendered lines, warm the cache so only compositing is measured
+    composite.get_frame(0)
+    bbox.get_frame(0)
+
+    composite_cost = time_frames(composite, args.duration)
+    bbox_cost = time_frames(bbox, args.duration)
+
+    print(f"CompositeVideoClip:  {composite_cost * 1000:7.2f} ms/frame")
+    print(f"SubtitleCompositor:  {bbox_cost * 1000:7.2f} ms/frame")
+    print(f"Speedup:             {composite_cost / bbox_cost:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Renders a JSONL file of projects without the web server.
+
+Every line of the input is a project config, the same JSON that POST /api/generate takes.
+One result per project is appended to the results file as soon as it has finished. Running
+the command again skips the projects that succeeded or failed before, unless --retry-failed
+is passed to run the failed ones again. Every other project picks up from the last stage it
+finished, since projects keep their intermediate outputs on disk.
+
+    python cli.py projects.jsonl --parallel 4 --results results.jsonl
+"""
+import argparse
+import hashlib
+import json
+import sys
+from pathlib import Path
+from threading import Lock
+
+from termcolor import colored
+
+from backend import LOGGER
+from backend.JobQueue import Job, JobQueue, JobState
+from backend.project.AIVideoProject import AIVideoProject
+
+
+def project_key(project: dict) -> str:
+    """
+    Identifies a project config across runs, independent of its line and key order.
+    """
+    return hashlib.sha256(json.dumps(project, sort_keys=True).encode()).hexdigest()
+
+
+def read_projects(path: Path) -> list[dict]:
+    projects = []
+    subjects = set()
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                project = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from e
+            if not isinstance(project, dict) or not project.get("videoSubject"):
+                raise ValueError(f"{path}:{line_number}: a 'videoSubject' is required.")
+            # Projects are stored by subject, two of them would overwrite each other's files
+            if project["videoSubject"] in subjects:
+                raise ValueError(f"{path}:{line_number}: repeats the subject '{project['videoSubject']}'.")
+            subjects.add(project["videoSubject"])
+            projects.append(project)
+    return projects
+
+
+def read_results(path: Path) -> dict[str, dict]:
+    """
+    The latest result of every project in an existing results file, by project key.
+    """
+    results = {}
+    if not path.exists():
+        return results
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the previous run was killed
+                continue
+            results[result["key"]] = result
+    return results
+
+
+def run(job: Job) -> None:
+    project = AIVideoProject(job.request_data, cancel_token=job.cancel_token)
+
+    def on_stage(stage: str, state: str) -> None:
+        job.set_stage(stage, state)
+        job.timings.update(project.stage_timings)
+        job.waits.update(project.stage_waits)
+
+    project.run(on_stage=on_stage)
+    job.artifacts.update(project.artifacts())
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("projects", type=Path, help="A JSONL file with one project config per line.")
+    parser.add_argument("--parallel", type=int, default=2, help="The number of projects that run at the same time.")
+    parser.add_argument(
+        "--results", type=Path, default=None,
+        help="The JSONL file results are appended to, defaults to <projects>.results.jsonl.",
+    )
+    parser.add_argument("--retry-failed", action="store_true", help="Also run projects that failed before.")
+    args = parser.parse_args()
+
+    results_path = args.results or args.projects.with_suffix(".results.jsonl")
+    try:
+        projects = read_projects(args.projects)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    done_states = {JobState.SUCCEEDED.value}
+    if not args.retry_failed:
+        done_states.add(JobState.FAILED.value)
+    previous = read_results(results_path)
+    pending = [
+        project for project in projects
+        if previous.get(project_key(project), {}).get("state") not in done_states
+    ]
+    print(colored(
+        f"[+] Running {len(pending)} of {len(projects)} projects, {len(projects) - len(pending)} finished before.",
+        "blue",
+    ))
+
+    indices = {project_key(project): i for i, project in enumerate(projects)}
+    lock = Lock()
+
+    def write_result(job: Job) -> None:
+        key = project_key(job.request_data)
+        result = {
+            "index": indices[key],
+            "key": key,
+            "videoSubject": job.request_data["videoSubject"],
+            "state": job.state.value,
+            "stage": job.stage,
+            "error": job.error,
+            "final": job.artifacts.get("final"),
+            "timings": job.timings,
+            "waits": job.waits,
+            "startedAt": job.started_at,
+            "finishedAt": job.finished_at,
+        }
+        with lock, open(results_path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        color = "green" if job.state == JobState.SUCCEEDED else "red"
+        print(colored(f"[{job.state.value}] {result['videoSubject']}", color))
+
+    queue = JobQueue(run, max_workers=max(1, args.parallel), on_finished=write_result)
+    jobs = [queue.submit(project) for project in pending]
+
+    try:
+        queue.shutdown(wait=True)
+    except KeyboardInterrupt:
+        # Let running projects stop at their next check, their finished stages are kept for the next run
+        print(colored("[!] Interrupted, cancelling the remaining projects...", "yellow"))
+        queue.cancel_all()
+        queue.shutdown(wait=True)
+
+    failed = [job for job in jobs if job.state != JobState.SUCCEEDED]
+    LOGGER.info(f"{len(jobs) - len(failed)} of {len(jobs)} projects succeeded, results in '{results_path}'.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
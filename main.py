@@ -1,26 +1,21 @@
+import hmac
 import json
-import random
 import os
 
 from backend.project.AIVideoProject import AIVideoProject
 from backend.MyHTTPException import MyHTTPException
+from backend.EncoderProfile import ENCODER_PROFILES
+from backend.JobQueue import Job, JobQueue, JobState
 from backend.gpt import generate_metadata
 from backend.video import generate_subtitles, combine_videos, generate_video
-from backend.tiktokvoice import tts
 from backend.youtube import upload_video
    
-from flask import Flask, Request, request, jsonify, Response 
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
 from termcolor import colored
 
 from moviepy.config import change_settings
-from moviepy.editor import (
-    AudioFileClip,
-    concatenate_audioclips,
-    VideoFileClip,
-    CompositeAudioClip,
-)
 
 from decouple import config
 
@@ -29,8 +24,14 @@ from backend import LOGGER
 # Set environment variables
 SESSION_ID = config("TIKTOK_SESSION_ID")
 openai_api_key = config("OPENAI_API_KEY")
-change_settings({"IMAGEMAGICK_BINARY": config("IMAGEMAGICK_BINARY")})
+# Subtitles are drawn with Pillow, ImageMagick is only needed for moviepy's own TextClip
+IMAGEMAGICK_BINARY = config("IMAGEMAGICK_BINARY", default="")
+if IMAGEMAGICK_BINARY:
+    change_settings({"IMAGEMAGICK_BINARY": IMAGEMAGICK_BINARY})
 PEXELS_API_KEY = config("PEXELS_API_KEY")
+MAX_CONCURRENT_JOBS = config("MAX_CONCURRENT_JOBS", default=2, cast=int)
+# Cancelling every job at once needs this token, without it only single jobs can be cancelled
+ADMIN_TOKEN = config("ADMIN_TOKEN", default="")
 
 
 # Initialize Flask
@@ -41,52 +42,145 @@ CORS(app)
 HOST = "0.0.0.0"
 PORT = 8080
 
-def select_song():
-    return random.choice(resources.resources.SONGS)
-
 @app.route("/api/generate", methods=["POST"])
 def generate_endpoint() -> Response:
-    result, err = generate(request)
-    if result:
-        return Response(
-            response=json.dumps(result),
-            status=200,
-            mimetype="application/json"
-        )
-    elif err:
-        return err.to_response()
-    else:
-        return MyHTTPException(500, "Unknown error").to_response()
-    
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict) or not request_data.get("videoSubject"):
+        return MyHTTPException(400, "A 'videoSubject' is required.").to_response()
 
+    job = JOBS.submit(request_data)
+    return Response(
+        response=json.dumps({
+            "status": "success",
+            "message": "Video generation queued.",
+            "data": {"jobId": job.id, "statusUrl": f"/api/jobs/{job.id}"},
+        }),
+        status=202,
+        mimetype="application/json"
+    )
 
-def generate(request: Request) -> tuple[dict|None,MyHTTPException|None]:
 
-    project = AIVideoProject(request.get_json())
-    
-    LOGGER.info(f"Generating video for '{project.config.videoSubject}'")
+@app.route("/api/generate/batch", methods=["POST"])
+def generate_batch_endpoint() -> Response:
+    """
+    Queue many projects at once. The body is either a JSON list of project configs, an object
+    with a "projects" list, or JSONL with one config per line, as the body or an uploaded "file".
+    """
+    try:
+        if "file" in request.files:
+            lines = request.files["file"].read().decode().splitlines()
+            projects = [json.loads(line) for line in lines if line.strip()]
+        elif request.is_json:
+            projects = request.get_json()
+            if isinstance(projects, dict):
+                projects = projects.get("projects")
+        else:
+            lines = request.get_data(as_text=True).splitlines()
+            projects = [json.loads(line) for line in lines if line.strip()]
+    except ValueError as e:
+        return MyHTTPException(400, f"Invalid batch: {e}").to_response()
+
+    if not isinstance(projects, list) or len(projects) == 0:
+        return MyHTTPException(400, "A non-empty list of projects is required.").to_response()
+
+    subjects = set()
+    for i, project in enumerate(projects):
+        if not isinstance(project, dict) or not project.get("videoSubject"):
+            return MyHTTPException(400, f"Project {i} has no 'videoSubject'.").to_response()
+        # Projects are stored by subject, two of them would overwrite each other's files
+        if project["videoSubject"] in subjects:
+            return MyHTTPException(400, f"Project {i} repeats the subject '{project['videoSubject']}'.").to_response()
+        subjects.add(project["videoSubject"])
+
+    batch = JOBS.submit_batch(projects)
+    return Response(
+        response=json.dumps({
+            "status": "success",
+            "message": f"{len(projects)} video generations queued.",
+            "data": {
+                "batchId": batch.id,
+                "statusUrl": f"/api/batches/{batch.id}",
+                "jobIds": [job.id for job in batch.jobs],
+            },
+        }),
+        status=202,
+        mimetype="application/json"
+    )
+
 
-    project.generate_script()
-    project.get_search_terms()
+@app.route("/api/batches/<batch_id>", methods=["GET"])
+def batch_status_endpoint(batch_id: str) -> Response:
+    batch = JOBS.get_batch(batch_id)
+    if batch is None:
+        return MyHTTPException(404, f"Batch '{batch_id}' not found.").to_response()
+    return Response(
+        response=json.dumps({"status": "success", "data": batch.report()}),
+        status=200,
+        mimetype="application/json"
+    )
 
-    video_paths = project.download_videos()
 
-    # Check if video_paths is empty
-    if len(project.videos)==0:
-        print(colored("[-] No videos found to download.", "red"))
-        return None, MyHTTPException(400, "No videos found to download on pexels api.")
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def job_status_endpoint(job_id: str) -> Response:
+    job = JOBS.get(job_id)
+    if job is None:
+        return MyHTTPException(404, f"Job '{job_id}' not found.").to_response()
+    return Response(
+        response=json.dumps({"status": "success", "data": job.to_dict()}),
+        status=200,
+        mimetype="application/json"
+    )
 
 
-    project.generate_tts()
-    project.get_subtitles()
+@app.route("/api/jobs/<job_id>/promote", methods=["POST"])
+def promote_endpoint(job_id: str) -> Response:
+    """
+    Queue the full-quality render of a draft. The project is the same, so the script, stock
+    videos, narration and subtitles of the draft are reused and only the video is encoded again.
+    """
+    job = JOBS.get(job_id)
+    if job is None:
+        return MyHTTPException(404, f"Job '{job_id}' not found.").to_response()
+    if job.request_data.get("encoderProfile", "final") == "final":
+        return MyHTTPException(400, f"Job '{job_id}' was not rendered as a draft.").to_response()
+    # The final render shares the project directory with the draft, so both must not run at once
+    if job.state != JobState.SUCCEEDED:
+        return MyHTTPException(409, f"Job '{job_id}' is {job.state.value}, only finished drafts can be promoted.").to_response()
+
+    encoder_profile = (request.get_json(silent=True) or {}).get("encoderProfile", "final")
+    if encoder_profile not in ENCODER_PROFILES:
+        return MyHTTPException(
+            400, f"Unknown encoder profile '{encoder_profile}', expected one of {tuple(ENCODER_PROFILES)}."
+        ).to_response()
+    promoted = JOBS.submit({**job.request_data, "encoderProfile": encoder_profile})
+    return Response(
+        response=json.dumps({
+            "status": "success",
+            "message": "Full-quality render queued.",
+            "data": {"jobId": promoted.id, "statusUrl": f"/api/jobs/{promoted.id}"},
+        }),
+        status=202,
+        mimetype="application/json"
+    )
 
-    project.make_final_video()
 
-    return {
-        "status": "success",
-        "message": "Video generated!",
-        "data": str(project.root / "output" / "final.mp4"),
-    },None
+def generate(job: Job) -> None:
+
+    project = AIVideoProject(job.request_data, cancel_token=job.cancel_token)
+    
+    LOGGER.info(f"Generating video for '{project.config.videoSubject}'")
+
+    def on_stage(stage: str, state: str) -> None:
+        job.set_stage(stage, state)
+        job.timings.update(project.stage_timings)
+        job.waits.update(project.stage_waits)
+        job.artifacts.update(project.artifacts())
+
+    final_video_path = project.run(on_stage=on_stage)
+    job.artifacts.update(project.artifacts())
+
+    print(colored(f"[+] Video generated: {final_video_path}!", "green"))
+    return
 
     # Define metadata for the video, we will display this to the user, and use it for the YouTube upload
     title, description, keywords = generate_metadata(
@@ -150,29 +244,6 @@ def generate(request: Request) -> tuple[dict|None,MyHTTPException|None]:
             except Exception as e:
                 print(f"An HTTP error occurred:{e}")
 
-    video_clip = VideoFileClip(str(final_video_path))
-    if project_config.useMusic:
-        # Select a random song
-        song_path = select_song()
-
-        # Add song to video at 30% volume using moviepy
-        original_duration = video_clip.duration
-        original_audio = video_clip.audio
-        song_clip = AudioFileClip(song_path).set_fps(44100)
-
-        # Set the volume of the song to 10% of the original volume
-        song_clip = song_clip.volumex(0.1).set_fps(44100)
-
-        # Add the song to the video
-        comp_audio = CompositeAudioClip([original_audio, song_clip])
-        video_clip = video_clip.set_audio(comp_audio)
-        video_clip = video_clip.set_fps(30)
-        video_clip = video_clip.set_duration(original_duration)
-        video_clip.write_videofile(
-            project_dir / "output" / "final_audio.mp4",
-            threads=project_config.threads or 1,
-        )
-
     # Let user know
     print(colored(f"[+] Video generated: {final_video_path}!", "green"))
 
@@ -187,14 +258,29 @@ def generate(request: Request) -> tuple[dict|None,MyHTTPException|None]:
     )
 
 
+JOBS = JobQueue(generate, max_workers=MAX_CONCURRENT_JOBS)
+
+
 @app.route("/api/cancel", methods=["POST"])
 def cancel():
     print(colored("[!] Received cancellation request...", "yellow"))
 
-    global GENERATING
-    GENERATING = False
+    data = request.get_json(silent=True) or {}
+    job_id = data.get("jobId")
+    if job_id:
+        if JOBS.cancel(job_id) is None:
+            return MyHTTPException(404, f"Job '{job_id}' not found.").to_response()
+        return jsonify({"status": "success", "message": f"Cancelled job '{job_id}'."})
+
+    if not data.get("all"):
+        return MyHTTPException(400, "Missing 'jobId' of the job to cancel.").to_response()
+
+    # Cancels the jobs of every user, so it is reserved for the administrator
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        return MyHTTPException(403, "Cancelling every job requires the admin token.").to_response()
 
-    return jsonify({"status": "success", "message": "Cancelled video generation."})
+    cancelled = JOBS.cancel_all()
+    return jsonify({"status": "success", "message": f"Cancelled {len(cancelled)} video generation(s)."})
 
 
 if __name__ == "__main__":
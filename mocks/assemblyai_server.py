@@ -0,0 +1,157 @@
+"""
+A local stand-in for the parts of the AssemblyAI API that subtitles are generated with:
+uploading audio, creating a transcript, polling it and exporting it as SRT.
+
+Transcripts take `--delay` seconds to complete, and their subtitles are a single caption
+that spans the duration of the uploaded MP3. Point the backend at it with:
+
+    python -m mocks.assemblyai_server --port 8089
+    ASSEMBLY_AI_API_KEY=mock ASSEMBLY_AI_BASE_URL=http://localhost:8089
+"""
+import argparse
+import json
+import re
+import tempfile
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock
+from uuid import uuid4
+
+from backend.audio import mp3_duration
+
+
+def srt_time(seconds: float) -> str:
+    ms = round(seconds * 1000)
+    return f"{timedelta(milliseconds=ms - ms % 1000)},{ms % 1000:03d}".rjust(12, "0")
+
+
+class MockAssemblyAI:
+    """
+    The state of the mock: uploaded audio and created transcripts.
+    """
+
+    def __init__(self, delay: float, text: str):
+        self.delay = delay
+        self.text = text
+        self.uploads_dir = Path(tempfile.mkdtemp(prefix="mock_assemblyai_"))
+        self.transcripts: dict[str, dict] = {}
+        self.lock = Lock()
+
+    def upload(self, data: bytes) -> str:
+        upload_id = uuid4().hex
+        (self.uploads_dir / upload_id).write_bytes(data)
+        return upload_id
+
+    def create(self, request: dict) -> dict:
+        transcript = {
+            "id": uuid4().hex,
+            "status": "queued",
+            "audio_url": request["audio_url"],
+            "language_code": request.get("language_code"),
+            "text": None,
+            "words": None,
+            "error": None,
+            "created": time.time(),
+        }
+        with self.lock:
+            self.transcripts[transcript["id"]] = transcript
+        return self.get(transcript["id"])
+
+    def _duration(self, transcript: dict) -> float:
+        upload = self.uploads_dir / transcript["audio_url"].rsplit("/", 1)[-1]
+        return mp3_duration(upload) if upload.exists() else 0
+
+    def get(self, transcript_id: str) -> dict | None:
+        with self.lock:
+            transcript = self.transcripts.get(transcript_id)
+            if transcript is None:
+                return None
+            if transcript["status"] != "completed" and time.time() - transcript["created"] >= self.delay:
+                transcript["status"] = "completed"
+                transcript["text"] = self.text
+                transcript["audio_duration"] = round(self._duration(transcript))
+            elif transcript["status"] == "queued":
+                transcript["status"] = "processing"
+            return {key: value for key, value in transcript.items() if key != "created"}
+
+    def srt(self, transcript_id: str) -> str | None:
+        transcript = self.get(transcript_id)
+        if transcript is None or transcript["status"] != "completed":
+            return None
+        duration = self._duration(transcript)
+        return f"1\n{srt_time(0)} --> {srt_time(duration)}\n{self.text}\n"
+
+
+def handler(mock: MockAssemblyAI, base_url: str):
+    class Handler(BaseHTTPRequestHandler):
+        def _body(self) -> bytes:
+            if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                data = b""
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return data
+                    data += self.rfile.read(size)
+                    self.rfile.readline()
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _send(self, status: int, body: dict | str) -> None:
+            if isinstance(body, dict):
+                data, content_type = json.dumps(body).encode(), "application/json"
+            else:
+                data, content_type = body.encode(), "text/plain"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path == "/v2/upload":
+                upload_id = mock.upload(self._body())
+                return self._send(200, {"upload_url": f"{base_url}/uploads/{upload_id}"})
+            if self.path == "/v2/transcript":
+                return self._send(200, mock.create(json.loads(self._body())))
+            self._send(404, {"error": "Not found"})
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            match = re.fullmatch(r"/v2/transcript/(\w+)(/srt)?", path)
+            if match is None:
+                return self._send(404, {"error": "Not found"})
+            transcript_id, srt = match.groups()
+            if srt:
+                subtitles = mock.srt(transcript_id)
+                if subtitles is None:
+                    return self._send(400, {"error": "Transcript is not completed"})
+                return self._send(200, subtitles)
+            transcript = mock.get(transcript_id)
+            if transcript is None:
+                return self._send(404, {"error": "Transcript not found"})
+            self._send(200, transcript)
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=2, help="Seconds until a transcript completes.")
+    parser.add_argument("--text", default="Mock transcript", help="The text of every transcript.")
+    args = parser.parse_args()
+
+    mock = MockAssemblyAI(args.delay, args.text)
+    server = ThreadingHTTPServer((args.host, args.port), handler(mock, f"http://{args.host}:{args.port}"))
+    print(f"Mock AssemblyAI listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()